@@ -0,0 +1,285 @@
+"""Asyncio read-only API for the CLI: package lookup, the catalog index and downloads.
+
+The routes `leaf` hits on every install are served by a plain ASGI app, so thousands of
+concurrent clients wait on sockets instead of holding the Flask workers that render pages,
+take uploads and hash passwords. It shares storage, schema and queries with server.py;
+SQLite calls run on a small thread pool (each thread keeps its own pooled connection) and
+file bytes are streamed in chunks read off the event loop.
+
+Run it next to the Flask app and route the CLI paths to it at the proxy:
+
+    uvicorn async_api:app --app-dir web      # /api/package/, /api/index, /userfiles/, /blobs/
+
+or serve everything from one ASGI server by handing it the Flask app through any
+WSGI-to-ASGI adapter, which receives every request this app does not handle:
+
+    app = async_api.create_app(fallback=WsgiToAsgi(server.app))
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import parse_qs, quote
+
+import server
+
+DB_THREADS = int(os.environ.get('LEAF_ASYNC_DB_THREADS', '8'))
+CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)')
+
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return '*' in tags or any(t.removeprefix('W/').strip('"') == etag for t in tags)
+
+
+def _if_range_matches(if_range, etag, mtime):
+    """If-Range holds a strong ETag or an HTTP date; the range applies only if it still describes the file."""
+    if if_range.startswith('"'):
+        return if_range.strip('"') == etag
+    if if_range.startswith('W/'):
+        return False
+    try:
+        return int(parsedate_to_datetime(if_range).timestamp()) == int(mtime)
+    except (TypeError, ValueError):
+        return False
+
+
+def _byte_range(header, size):
+    """(start, end) inclusive for a single-range Range header; None to send the whole file
+    (absent, malformed or several ranges); 'unsatisfiable' when it lies past the end."""
+    m = RANGE_RE.fullmatch(header.strip()) if header else None
+    if not m or m.group(1) == m.group(2) == '':
+        return None
+    if m.group(1) == '':
+        suffix = int(m.group(2))
+        if suffix == 0 or size == 0:
+            return 'unsatisfiable'
+        return max(0, size - suffix), size - 1
+    start = int(m.group(1))
+    if m.group(2) and int(m.group(2)) < start:
+        return None  # invalid, so ignored
+    if start >= size:
+        return 'unsatisfiable'
+    return start, min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+
+
+class Response:
+    def __init__(self, status, body=b'', headers=None, path=None, size=None, offset=0):
+        self.status = status
+        self.body = body
+        self.headers = dict(headers or {})
+        self.path = path  # stream size bytes of this file from offset instead of body
+        self.size = size
+        self.offset = offset
+
+    @classmethod
+    def json(cls, data, status=200, headers=None):
+        body = data if isinstance(data, (bytes, str)) else json.dumps(data)
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        return cls(status, body, dict(headers or {}, **{'Content-Type': 'application/json'}))
+
+
+class AsyncAPI:
+    """ASGI app for the read-only CLI routes; anything else goes to fallback (or 404)."""
+
+    def __init__(self, fallback=None, db_threads=DB_THREADS):
+        self.fallback = fallback
+        self._executor = ThreadPoolExecutor(db_threads, thread_name_prefix='leaf-async-db')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            if self.fallback:
+                return await self.fallback(scope, receive, send)
+            return
+        handler, args = self._route(scope['path'])
+        if handler is None or scope['method'] not in ('GET', 'HEAD'):
+            if self.fallback:
+                return await self.fallback(scope, receive, send)
+            return await self._send(scope, send, Response.json({'error': 'Not found'}, 404))
+        headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True)
+        try:
+            resp = await handler(headers, query, *args)
+        except Exception:
+            logging.exception('async api error on %s', scope['path'])
+            resp = Response.json({'error': 'Internal server error'}, 500)
+        await self._send(scope, send, resp)
+
+    def _route(self, path):
+        parts = path.split('/')
+        if path.startswith('/api/package/') and len(parts) == 4:
+            return self.api_package, (parts[3],)
+        if path.startswith('/api/package/') and len(parts) == 5 and parts[4] == 'versions':
+            return self.api_package_versions, (parts[3],)
+        if path == '/api/index':
+            return self.api_index, ()
+        if path.startswith('/userfiles/') and len(parts) >= 4:
+            return self.user_file, (parts[2], '/'.join(parts[3:]))
+        if path.startswith('/blobs/') and len(parts) == 3:
+            return self.blob, (parts[2],)
+        return None, ()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def db(self, fn, *args):
+        """Run a blocking server.py query on the database threads."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    # --- routes (same responses as the Flask views of the same paths) ---------------------------------
+
+    async def api_package(self, headers, query, name):
+        name = name.strip()
+        if not name:
+            return Response.json({'error': 'Package name required'}, 400)
+        if 'version' in query:
+            constraint = query['version'][0]
+            try:
+                version = await self.db(server.resolve_package_version, name, constraint)
+            except ValueError as e:
+                return Response.json({'error': str(e)}, 400)
+            if not version:
+                return Response.json({'error': 'No matching version', 'found': False, 'constraint': constraint}, 404)
+            headers = {}
+            if constraint.strip() == version['version']:
+                headers['Cache-Control'] = f'public, max-age={server.BLOB_MAX_AGE}, immutable'
+            return Response.json(dict(found=True, **server.version_payload(version)), headers=headers)
+        pkg = await self.db(server.get_package_by_name, name)
+        if not pkg:
+            return Response.json({'error': 'Package not found', 'found': False}, 404)
+        return Response.json(dict(found=True, **server.package_payload(pkg)))
+
+    async def api_package_versions(self, headers, query, name):
+        versions = await self.db(server.get_package_versions, name.strip())
+        if not versions:
+            return Response.json({'error': 'Package not found', 'found': False}, 404)
+        return Response.json({'found': True, 'name': versions[0]['name'],
+                              'versions': [server.version_payload(v) for v in versions]})
+
+    async def api_index(self, headers, query):
+        try:
+            since = int(query['since'][0]) if 'since' in query else None
+        except ValueError:
+            since = None
+        etag, render = await self.db(server.package_index_document, since)
+        cache_headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+        if _etag_matches(headers.get('if-none-match'), etag):
+            return Response(304, headers=cache_headers)
+        return Response.json(await self.db(render), headers=cache_headers)
+
+    async def user_file(self, headers, query, username, filename):
+        if not server.allowed_file(filename):
+            return Response.json({'error': 'Bad request'}, 400)
+        user_dir = os.path.join(server.PUBLIC_DIR, username)
+        path = os.path.normpath(os.path.join(user_dir, filename))
+        try:
+            if os.path.commonpath([user_dir, path]) != user_dir:
+                return Response.json({'error': 'Forbidden'}, 403)
+        except ValueError:
+            return Response.json({'error': 'Bad request'}, 400)
+        relpath = os.path.relpath(path, server.PUBLIC_DIR)
+        disposition = f"attachment; filename*=UTF-8''{quote(os.path.basename(path))}"
+        cache_control = f'public, max-age={server.PACKAGE_MAX_AGE}'
+        if server.ACCEL_REDIRECT_PREFIX:
+            st = await self.db(_stat_file, path)
+            if st is None:
+                return Response.json({'error': 'Not found'}, 404)
+            return Response(200, headers={
+                'X-Accel-Redirect': server.ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + quote(relpath),
+                'Content-Type': 'application/octet-stream', 'Content-Disposition': disposition,
+                'Cache-Control': cache_control})
+        return await self._file(headers, path, None, disposition, cache_control)
+
+    async def blob(self, headers, query, digest):
+        if not server.BLOB_DIGEST_RE.fullmatch(digest):
+            return Response.json({'error': 'Not found'}, 404)
+        return await self._file(headers, server.blob_path(digest), digest,
+                                f'attachment; filename={digest}.leaf',
+                                f'public, max-age={server.BLOB_MAX_AGE}, immutable')
+
+    async def _file(self, headers, path, etag, disposition, cache_control):
+        st = await self.db(_stat_file, path)
+        if st is None:
+            return Response.json({'error': 'Not found'}, 404)
+        etag = etag or f'{st.st_mtime_ns:x}-{st.st_size:x}'
+        resp_headers = {'ETag': f'"{etag}"', 'Cache-Control': cache_control,
+                        'Last-Modified': formatdate(st.st_mtime, usegmt=True), 'Accept-Ranges': 'bytes'}
+        if _etag_matches(headers.get('if-none-match'), etag):
+            return Response(304, headers=resp_headers)
+        resp_headers.update({'Content-Type': 'application/octet-stream', 'Content-Disposition': disposition})
+        # resumed downloads: one byte range, as werkzeug's conditional send_file answers it
+        byte_range = None
+        if 'range' in headers and ('if-range' not in headers
+                                   or _if_range_matches(headers['if-range'], etag, st.st_mtime)):
+            byte_range = _byte_range(headers['range'], st.st_size)
+        if byte_range == 'unsatisfiable':
+            resp_headers['Content-Range'] = f'bytes */{st.st_size}'
+            return Response(416, headers=resp_headers)
+        if byte_range:
+            start, end = byte_range
+            resp_headers['Content-Range'] = f'bytes {start}-{end}/{st.st_size}'
+            return Response(206, headers=resp_headers, path=path, size=end - start + 1, offset=start)
+        return Response(200, headers=resp_headers, path=path, size=st.st_size)
+
+    async def _send(self, scope, send, resp):
+        headers = resp.headers
+        size = resp.size if resp.path else len(resp.body)
+        if resp.status != 304:
+            headers['Content-Length'] = str(size)
+        await send({'type': 'http.response.start', 'status': resp.status,
+                    'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers.items()]})
+        if scope['method'] == 'HEAD' or resp.status == 304:
+            await send({'type': 'http.response.body', 'body': b''})
+        elif resp.path is None:
+            await send({'type': 'http.response.body', 'body': resp.body})
+        elif resp.status == 200 and 'http.response.pathsend' in scope.get('extensions', {}):
+            # the server sends the file itself (e.g. with sendfile); pathsend has no ranges
+            await send({'type': 'http.response.pathsend', 'path': resp.path})
+        else:
+            await self._stream_file(send, resp.path, resp.offset, resp.size)
+
+    async def _stream_file(self, send, path, offset, length):
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(self._executor, open, path, 'rb')
+        try:
+            if offset:
+                f.seek(offset)
+            while True:
+                chunk = await loop.run_in_executor(self._executor, f.read, min(CHUNK_SIZE, length))
+                length -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': bool(chunk) and length > 0})
+                if not chunk or length <= 0:
+                    break
+        finally:
+            f.close()
+
+
+def _stat_file(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st if stat.S_ISREG(st.st_mode) else None
+
+
+def create_app(fallback=None):
+    return AsyncAPI(fallback)
+
+
+app = create_app()
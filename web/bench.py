@@ -0,0 +1,199 @@
+"""Reproducible load benchmark for the web server's hot endpoints.
+
+Seeds a throwaway storage tree with users, packages and posts, drives the app
+through Flask's test client and prints throughput, latency percentiles and SQL
+query counts per endpoint as JSON:
+
+    python3 web/bench.py --users 200 --packages 5000 --requests 500 > before.json
+
+Runs are deterministic for a given --seed, so results can be compared between
+commits and catalog sizes.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+WEB_DIR = os.path.abspath(os.path.dirname(__file__))
+
+WORDS = ['leaf', 'tree', 'root', 'branch', 'moss', 'fern', 'pine', 'oak', 'cedar', 'birch',
+         'maple', 'willow', 'sprout', 'seed', 'bark', 'twig', 'bloom', 'petal', 'vine', 'grove']
+
+
+def seed_tree(root, users, packages, rng):
+    """Write package manifests under root/storage/public; returns (usernames, [(user, filename)])."""
+    public = os.path.join(root, 'storage', 'public')
+    usernames = [f'user{i:05d}' for i in range(users)]
+    published = []
+    for i in range(packages):
+        username = rng.choice(usernames)
+        name = f'{rng.choice(WORDS)}-{rng.choice(WORDS)}-{i}'
+        deps = [f'{rng.choice(WORDS)}-{rng.choice(WORDS)}-{rng.randrange(i)}' for _ in range(rng.randrange(4))] if i else []
+        lines = [f'name: {name}', f'version: {rng.randrange(5)}.{rng.randrange(20)}.{rng.randrange(50)}',
+                 f'description: {" ".join(rng.choice(WORDS) for _ in range(8))}', f'author: {username}',
+                 'license: MIT']
+        if deps:
+            lines.append('dependencies:')
+            lines.extend(f'  - {dep}' for dep in deps)
+        user_dir = os.path.join(public, username)
+        os.makedirs(user_dir, exist_ok=True)
+        with open(os.path.join(user_dir, f'{name}.leaf'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        published.append((username, f'{name}.leaf'))
+    return usernames, published
+
+
+def seed_db(server, usernames, posts, rng):
+    # a real hash once, reused for every row: hashing per user would dominate seeding
+    from werkzeug.security import generate_password_hash
+    password_hash = generate_password_hash('bench')
+    conn = server.get_db()
+    conn.executemany('INSERT INTO users (username, password_hash, bio, username_changed_at, uuid, role) VALUES (?, ?, ?, ?, ?, ?)',
+                     [(u, password_hash, '', 0, f'bench-{u}', 'member') for u in usernames])
+    if server.USER_FTS:
+        conn.execute('INSERT INTO users_fts (rowid, username) SELECT id, username FROM users')
+    now = int(time.time())
+    conn.executemany('INSERT INTO posts (author, title, content, created_at) VALUES (?, ?, ?, ?)',
+                     [('bench', f'Post {i}', ' '.join(rng.choice(WORDS) for _ in range(40)), now - i) for i in range(posts)])
+    conn.commit()
+    server.release_thread_db()
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def run_endpoint(server, paths, requests, threads, warmup):
+    """Issue requests GETs cycling through paths; returns latency/throughput/query stats."""
+    app = server.app
+    for path in paths[:warmup]:
+        app.test_client().get(path)
+
+    def worker(worker_id):
+        client = app.test_client()
+        latencies = []
+        statuses = {}
+        for i in range(worker_id, requests, threads):
+            path = paths[i % len(paths)]
+            start = time.perf_counter()
+            resp = client.get(path)
+            resp.close()
+            latencies.append(time.perf_counter() - start)
+            statuses[resp.status_code] = statuses.get(resp.status_code, 0) + 1
+        return latencies, statuses
+
+    queries_before = server.db_stats()['queries']
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(worker, range(threads)))
+    elapsed = time.perf_counter() - started
+    queries = server.db_stats()['queries'] - queries_before
+
+    latencies = sorted(l for lats, _ in results for l in lats)
+    statuses = {}
+    for _, st in results:
+        for code, count in st.items():
+            statuses[str(code)] = statuses.get(str(code), 0) + count
+    ms = [l * 1000 for l in latencies]
+    return {
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'mean_ms': round(statistics.fmean(ms), 3) if ms else 0.0,
+        'p50_ms': round(percentile(ms, 50), 3),
+        'p95_ms': round(percentile(ms, 95), 3),
+        'p99_ms': round(percentile(ms, 99), 3),
+        'max_ms': round(ms[-1], 3) if ms else 0.0,
+        'queries_per_request': round(queries / len(latencies), 2) if latencies else 0.0,
+        'status': statuses,
+    }
+
+
+def git_revision():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=WEB_DIR, capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--packages', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=300, help='requests per endpoint')
+    parser.add_argument('--threads', type=int, default=1, help='concurrent clients per endpoint')
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests per endpoint')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--endpoints', help='comma-separated subset of endpoint names to run')
+    parser.add_argument('--keep', action='store_true', help='keep the seeded storage tree')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    root = tempfile.mkdtemp(prefix='leaf-bench-')
+    try:
+        usernames, published = seed_tree(root, args.users, args.packages, rng)
+        os.environ['LEAF_STORAGE_ROOT'] = root
+        os.environ.setdefault('SECRET_KEY', 'bench')
+        sys.path.insert(0, WEB_DIR)
+        started = time.perf_counter()
+        import server  # first import runs init_db and the startup package sync
+        startup = time.perf_counter() - started
+        seed_db(server, usernames, args.posts, rng)
+
+        sample = rng.sample(published, min(len(published), 200))
+        terms = [rng.choice(WORDS) for _ in range(50)] + [u[:6] for u in rng.sample(usernames, min(len(usernames), 20))]
+        endpoints = {
+            'index': ['/'],
+            'search': [f'/search?q={t}' for t in terms],
+            'packages': ['/packages', '/packages?sort=date&order=desc', '/packages?sort=size&page=3'],
+            'package_info': [f'/package/{u}/{f}' for u, f in sample],
+            'api_package': [f"/api/package/{f.rsplit('.', 1)[0]}" for _, f in sample],
+            'userfiles': [f'/userfiles/{u}/{f}' for u, f in sample],
+        }
+        if args.endpoints:
+            wanted = set(args.endpoints.split(','))
+            endpoints = {k: v for k, v in endpoints.items() if k in wanted}
+
+        report = {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'params': {k: getattr(args, k) for k in ('users', 'packages', 'posts', 'requests', 'threads', 'seed')},
+            'startup_seconds': round(startup, 3),
+            'endpoints': {},
+        }
+        for name, paths in endpoints.items():
+            report['endpoints'][name] = run_endpoint(server, paths, args.requests, args.threads, args.warmup)
+        report['db'] = server.db_stats()
+    finally:
+        if args.keep:
+            print(f'storage tree kept at {root}', file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    out = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+
+if __name__ == '__main__':
+    main()
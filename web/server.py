@@ -1,16 +1,35 @@
-from flask import Flask, render_template, send_from_directory, send_file, abort, redirect, url_for, request, session, flash, jsonify
+from flask import Flask, render_template, send_from_directory, send_file, abort, redirect, url_for, request, session, flash, jsonify, g, has_app_context
+from flask import before_render_template, template_rendered, Request
 from flask_wtf import FlaskForm
 from wtforms import FileField, SubmitField
 from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
+from markupsafe import Markup
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
 import pathlib
 import os
+import stat
 import sqlite3
 import uuid
 import time
 import shutil
 import logging
+import threading
+import bisect
+import sys
+import click
+import re
+import hashlib
+import hmac
+import codecs
+import json
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
 from datetime import datetime
+from urllib.parse import quote
 from wtforms.validators import InputRequired
 
 # Configure logging
@@ -33,27 +52,469 @@ if app.config['SECRET_KEY'] == 'dev-only-change-me':
 app.config['UPLOAD_FOLDER'] = 'storage/submissions'
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-PUBLIC_DIR = os.path.join(BASE_DIR, 'storage', 'public')
-SUBMISSIONS_DIR = os.path.join(BASE_DIR, 'storage', 'submissions')
+# where storage/ and data/ live; override to run against another tree (e.g. the benchmark's)
+STORAGE_ROOT = os.path.abspath(os.environ.get('LEAF_STORAGE_ROOT', BASE_DIR))
+PUBLIC_DIR = os.path.join(STORAGE_ROOT, 'storage', 'public')
+SUBMISSIONS_DIR = os.path.join(STORAGE_ROOT, 'storage', 'submissions')
+# content-addressed package bytes (blobs/<first two hex chars>/<sha256>) and scratch space for publishes
+BLOBS_DIR = os.path.join(STORAGE_ROOT, 'storage', 'blobs')
+STAGING_DIR = os.path.join(STORAGE_ROOT, 'storage', 'staging')
 
 ALLOWED_EXT = {'.leaf'}
 
+# request body cap for everything (avatars included), and the tighter cap for package uploads
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('LEAF_MAX_REQUEST_BYTES', str(8 * 1024 * 1024)))
+MAX_UPLOAD_BYTES = int(os.environ.get('LEAF_MAX_UPLOAD_BYTES', str(1024 * 1024)))
+# room for the multipart framing and the CSRF field around the uploaded file
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+# a request that crashed the worker never reaches discard(); its .upload file is swept after this
+UPLOAD_STAGING_MAX_AGE = int(os.environ.get('LEAF_UPLOAD_STAGING_MAX_AGE', '3600'))
+
+# package downloads: how long clients/proxies may reuse a copy before revalidating
+PACKAGE_MAX_AGE = int(os.environ.get('LEAF_PACKAGE_MAX_AGE', '300'))
+# let the front-end proxy send package bytes: Apache/lighttpd X-Sendfile, or an nginx
+# internal location (e.g. /_public/) that maps onto PUBLIC_DIR for X-Accel-Redirect
+app.config['USE_X_SENDFILE'] = os.environ.get('LEAF_USE_X_SENDFILE', 'false').lower() == 'true'
+ACCEL_REDIRECT_PREFIX = os.environ.get('LEAF_ACCEL_REDIRECT_PREFIX', '')
+
 def allowed_file(filename):
     return pathlib.Path(filename).suffix.lower() in ALLOWED_EXT
 
+
+class StagedUpload:
+    """File object an uploaded package is streamed into.
+
+    The bytes go straight to a file under STAGING_DIR and are hashed and checked on the
+    way in, so publishing needs no second pass: the caller renames the staged file into
+    place and hands the digest to the blob store.
+    """
+
+    def __init__(self):
+        os.makedirs(STAGING_DIR, exist_ok=True)
+        self.path = os.path.join(STAGING_DIR, f'{uuid.uuid4().hex}.upload')
+        self._file = open(self.path, 'w+b')
+        self._hash = hashlib.sha256()
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._tail = ''
+        self.size = 0
+        self.is_text = True
+        self.has_name = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > MAX_UPLOAD_BYTES:
+            raise RequestEntityTooLarge()
+        self._hash.update(data)
+        self._scan(data)
+        return self._file.write(data)
+
+    def _scan(self, data, final=False):
+        # a manifest must be UTF-8 text with a top-level `name:` entry (see parse_leaf_manifest)
+        if not self.is_text:
+            return
+        try:
+            text = self._decoder.decode(data, final)
+        except UnicodeDecodeError:
+            self.is_text = False
+            return
+        if self.has_name:
+            return
+        lines = (self._tail + text).split('\n')
+        self._tail = '' if final else lines.pop()
+        for line in lines:
+            if line[:1] in (' ', '\t'):
+                continue
+            key, sep, value = line.partition(':')
+            if sep and key.strip().lower() == 'name' and value.strip():
+                self.has_name = True
+                self._tail = ''
+                break
+
+    def finish(self):
+        """Flush the staged file and return (sha256, error message or None)."""
+        self._scan(b'', final=True)
+        self._file.flush()
+        if not self.is_text:
+            return None, 'Manifest is not valid UTF-8 text'
+        if not self.has_name:
+            return None, 'Manifest has no name: entry'
+        return self._hash.hexdigest(), None
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def __getattr__(self, name):
+        # seek/read/tell/close for werkzeug's FileStorage
+        return getattr(self._file, name)
+
+
+class LeafRequest(Request):
+    """Streams package uploads into STAGING_DIR under MAX_UPLOAD_BYTES."""
+
+    STREAMED_ENDPOINTS = ('upload',)
+
+    @property
+    def max_content_length(self):
+        if self.endpoint in self.STREAMED_ENDPOINTS:
+            return MAX_UPLOAD_BYTES + UPLOAD_FORM_OVERHEAD
+        return super().max_content_length
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint not in self.STREAMED_ENDPOINTS:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        upload = StagedUpload()
+        self.__dict__.setdefault('staged_uploads', []).append(upload)
+        return upload
+
+
+app.request_class = LeafRequest
+
+
+@app.teardown_request
+def discard_staged_uploads(exc):
+    # whatever the view didn't publish (rejected, failed, or never looked at) is dropped
+    for upload in request.__dict__.get('staged_uploads', ()):
+        upload.discard()
+
 class UploadFileForm(FlaskForm):
     file = FileField("File", validators=[InputRequired()])
     submit = SubmitField("Upload File")
 
 # --- simple sqlite-backed user store -----------------------------------------------------------------
-DB_PATH = os.path.join(BASE_DIR, 'data', 'users.db')
+DB_PATH = os.path.join(STORAGE_ROOT, 'data', 'users.db')
 
 # supported avatar extensions
 AVATAR_EXTS = ['.jpg', '.jpeg', '.png']
+PROFILES_DIR = os.path.join(BASE_DIR, 'static', 'images', 'profiles')
+
+# pragmas applied to every pooled connection; WAL lets readers proceed while a write is in flight
+DB_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -8000',
+)
+DB_POOL_SIZE = int(os.environ.get('LEAF_DB_POOL_SIZE', '8'))
+
+_db_stats_lock = threading.Lock()
+_db_stats = {
+    'connections_opened': 0,
+    'connections_reused': 0,
+    'queries': 0,
+    'query_time': 0.0,
+    'requests': 0,
+}
+
+
+def _record_query(elapsed):
+    with _db_stats_lock:
+        _db_stats['queries'] += 1
+        _db_stats['query_time'] += elapsed
+    sample = getattr(_request_sample, 'current', None)
+    if sample is not None:
+        sample['db_queries'] += 1
+        sample['db_seconds'] += elapsed
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that counts and times every statement it runs."""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_query(time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record_query(time.perf_counter() - start)
+
+
+class PooledConnection(sqlite3.Connection):
+    """Connection whose cursors (including conn.execute shortcuts) are timed."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class ConnectionPool:
+    """Small LIFO pool of sqlite connections shared by request handlers."""
+
+    def __init__(self, size):
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(DB_PATH, factory=PooledConnection, check_same_thread=False)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        with _db_stats_lock:
+            _db_stats['connections_opened'] += 1
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            return self._connect()
+        with _db_stats_lock:
+            _db_stats['connections_reused'] += 1
+        return conn
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def reset(self):
+        """Drop idle connections without closing them (used after fork)."""
+        with self._lock:
+            self._idle = []
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+db_pool = ConnectionPool(DB_POOL_SIZE)
+_db_local = threading.local()
+
+
+def get_db():
+    """Return the connection for the current request, or for this thread outside a request."""
+    if has_app_context():
+        conn = g.get('_db_conn')
+        if conn is None:
+            conn = g._db_conn = db_pool.acquire()
+        return conn
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = _db_local.conn = db_pool.acquire()
+    return conn
+
+
+def release_thread_db():
+    """Return this thread's out-of-request connection to the pool."""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None:
+        _db_local.conn = None
+        db_pool.release(conn)
+
+
+def _reset_db_after_fork():
+    # connections must never be shared across processes; children open their own
+    db_pool.reset()
+    _db_local.conn = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_db_after_fork)
+
+
+@app.teardown_appcontext
+def release_request_db(exc):
+    conn = g.pop('_db_conn', None)
+    if conn is not None:
+        with _db_stats_lock:
+            _db_stats['requests'] += 1
+        db_pool.release(conn)
+
+
+def db_stats():
+    """Snapshot of connection and query counters."""
+    with _db_stats_lock:
+        stats = dict(_db_stats)
+    stats['query_time_ms'] = round(stats.pop('query_time') * 1000, 3)
+    stats['queries_per_request'] = round(stats['queries'] / stats['requests'], 2) if stats['requests'] else 0
+    stats['pool_idle'] = len(db_pool._idle)
+    stats['pool_size'] = db_pool.size
+    return stats
+
+
+# --- request metrics (exported at /metrics) -----------------------------------------------------------
+# Each request accumulates into a plain dict on a thread-local; it is folded into the
+# shared registry under one lock acquisition when the request ends.
+_request_sample = threading.local()
+# opt-in; /metrics then answers only requests bearing LEAF_METRICS_TOKEN
+METRICS_ENABLED = os.environ.get('LEAF_METRICS', 'false').lower() == 'true'
+METRICS_TOKEN = os.environ.get('LEAF_METRICS_TOKEN', '')
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# audited events that touch the filesystem (os.stat has no audit event, so it isn't counted)
+FS_AUDIT_EVENTS = frozenset(('open', 'os.listdir', 'os.scandir', 'os.remove', 'os.rename', 'os.link',
+                             'os.chmod', 'os.mkdir', 'shutil.copyfile', 'shutil.move'))
+# per-request sums exported as leaf_request_<name>_total{endpoint=...}
+SAMPLE_FIELDS = ('db_queries', 'db_seconds', 'fs_calls', 'manifest_seconds', 'template_seconds')
+SAMPLE_HELP = {
+    'fs_calls': 'Sum of per-request audited filesystem calls (open, listdir, remove, rename, ...) by endpoint; '
+                'os.stat and os.path.exists raise no audit event and are not counted.',
+}
+
+class RequestMetrics:
+    """Per-endpoint latency histograms and resource sums."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._endpoints = {}  # endpoint -> {'buckets': [...], 'count', 'sum', SAMPLE_FIELDS...}
+        self._statuses = {}   # (endpoint, status) -> count
+
+    def observe(self, endpoint, status, duration, sample):
+        slot = bisect.bisect_left(self.buckets, duration)
+        with self._lock:
+            entry = self._endpoints.get(endpoint)
+            if entry is None:
+                entry = self._endpoints[endpoint] = dict({f: 0 for f in SAMPLE_FIELDS},
+                                                         buckets=[0] * (len(self.buckets) + 1), count=0, sum=0.0)
+            entry['buckets'][slot] += 1
+            entry['count'] += 1
+            entry['sum'] += duration
+            for field in SAMPLE_FIELDS:
+                entry[field] += sample[field]
+            key = (endpoint, status)
+            self._statuses[key] = self._statuses.get(key, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            endpoints = {k: dict(v, buckets=list(v['buckets'])) for k, v in self._endpoints.items()}
+            return endpoints, dict(self._statuses)
+
+
+request_metrics = RequestMetrics(LATENCY_BUCKETS)
+
+
+def _new_sample():
+    return dict.fromkeys(SAMPLE_FIELDS, 0)
+
+
+def _count_fs_calls(event, args):
+    if event in FS_AUDIT_EVENTS:
+        sample = getattr(_request_sample, 'current', None)
+        if sample is not None:
+            sample['fs_calls'] += 1
+
+
+def _note_template_start(sender, template, context, **extra):
+    sample = getattr(_request_sample, 'current', None)
+    if sample is not None:
+        sample['_template_started'] = time.perf_counter()
+
+
+def _note_template_done(sender, template, context, **extra):
+    sample = getattr(_request_sample, 'current', None)
+    if sample is not None and '_template_started' in sample:
+        sample['template_seconds'] += time.perf_counter() - sample.pop('_template_started')
+
+
+if METRICS_ENABLED and not METRICS_TOKEN:
+    logging.warning('LEAF_METRICS is on but LEAF_METRICS_TOKEN is unset; /metrics will refuse every scrape')
+if METRICS_ENABLED:
+    # audit hooks can't be removed, so they are only installed when metrics are on
+    sys.addaudithook(_count_fs_calls)
+    before_render_template.connect(_note_template_start, app)
+    template_rendered.connect(_note_template_done, app)
+
+    @app.before_request
+    def start_request_metrics():
+        _request_sample.current = _new_sample()
+        _request_sample.started = time.perf_counter()
+        _request_sample.status = 500
+
+    @app.after_request
+    def note_response_status(response):
+        _request_sample.status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request_metrics(exc):
+        sample = getattr(_request_sample, 'current', None)
+        if sample is None:
+            return
+        _request_sample.current = None
+        duration = time.perf_counter() - _request_sample.started
+        endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+        request_metrics.observe(endpoint, _request_sample.status, duration, sample)
+
+
+def _prom_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    endpoints, statuses = request_metrics.snapshot()
+    out = []
+    out.append('# HELP leaf_http_request_duration_seconds Request latency by endpoint.')
+    out.append('# TYPE leaf_http_request_duration_seconds histogram')
+    for endpoint, entry in sorted(endpoints.items()):
+        label = f'endpoint="{_prom_escape(endpoint)}"'
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, entry['buckets']):
+            cumulative += count
+            out.append(f'leaf_http_request_duration_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+        out.append(f'leaf_http_request_duration_seconds_bucket{{{label},le="+Inf"}} {entry["count"]}')
+        out.append(f'leaf_http_request_duration_seconds_sum{{{label}}} {entry["sum"]:.6f}')
+        out.append(f'leaf_http_request_duration_seconds_count{{{label}}} {entry["count"]}')
+    out.append('# HELP leaf_http_requests_total Requests by endpoint and status code.')
+    out.append('# TYPE leaf_http_requests_total counter')
+    for (endpoint, status), count in sorted(statuses.items()):
+        out.append(f'leaf_http_requests_total{{endpoint="{_prom_escape(endpoint)}",status="{status}"}} {count}')
+    for field in SAMPLE_FIELDS:
+        help_text = SAMPLE_HELP.get(field, f'Sum of per-request {field.replace("_", " ")} by endpoint.')
+        out.append(f'# HELP leaf_request_{field}_total {help_text}')
+        out.append(f'# TYPE leaf_request_{field}_total counter')
+        for endpoint, entry in sorted(endpoints.items()):
+            out.append(f'leaf_request_{field}_total{{endpoint="{_prom_escape(endpoint)}"}} {entry[field]}')
+
+    snapshots = [
+        ('leaf_db', db_stats(), ('connections_opened', 'connections_reused', 'queries', 'pool_idle')),
+        ('leaf_manifest_cache', manifest_cache.stats(), ('entries', 'bytes', 'hits', 'misses', 'evictions')),
+        ('leaf_session_user_cache', session_user_cache.stats(), ('entries', 'hits', 'misses')),
+        ('leaf_page_cache', page_cache.stats(), ('entries', 'hits', 'misses')),
+        ('leaf_password_hasher', password_hasher.stats(),
+         ('hashes', 'verifies', 'rehashes', 'rejected', 'in_flight', 'queued', 'seconds')),
+    ]
+    for prefix, stats, keys in snapshots:
+        for key in keys:
+            # Prometheus counters carry a _total suffix; gauges keep the plain name
+            if key in ('entries', 'bytes', 'pool_idle', 'in_flight', 'queued'):
+                kind, metric = 'gauge', f'{prefix}_{key}'
+            else:
+                kind, metric = 'counter', f'{prefix}_{key}_total'
+            out.append(f'# TYPE {metric} {kind}')
+            out.append(f'{metric} {stats[key]}')
+    return '\n'.join(out) + '\n'
+
 
 def init_db():
+    global PACKAGE_FTS, USER_FTS
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -86,12 +547,52 @@ def init_db():
     # add ban_until column if missing
     if 'ban_until' not in cols:
         c.execute("ALTER TABLE users ADD COLUMN ban_until INTEGER DEFAULT 0")
+    # avatar extension + cache-busting version, so rendering never probes the filesystem
+    if 'avatar_ext' not in cols:
+        c.execute("ALTER TABLE users ADD COLUMN avatar_ext TEXT DEFAULT ''")
+        c.execute("ALTER TABLE users ADD COLUMN avatar_version INTEGER DEFAULT 0")
+        conn.commit()
+        # backfill from whatever avatars are already on disk
+        if os.path.isdir(PROFILES_DIR):
+            for fn in sorted(os.listdir(PROFILES_DIR)):
+                stem, ext = os.path.splitext(fn)
+                if ext.lower() not in AVATAR_EXTS:
+                    continue
+                try:
+                    version = int(os.path.getmtime(os.path.join(PROFILES_DIR, fn)))
+                except OSError:
+                    version = 0
+                c.execute("UPDATE users SET avatar_ext = ?, avatar_version = ? WHERE username = ? AND avatar_ext = ''",
+                          (ext, version, stem))
     # ensure specific owner user
     try:
         c.execute("UPDATE users SET role = 'owner' WHERE LOWER(username) = 'frogman'")
     except Exception:
         pass
+    # bumped by any change to the user fields SessionUserCache holds, from any process
+    # (or straight in the database), so every worker's cache can tell it is stale
+    c.execute('CREATE TABLE IF NOT EXISTS cache_generations (name TEXT PRIMARY KEY, generation INTEGER NOT NULL)')
+    c.execute("INSERT OR IGNORE INTO cache_generations (name, generation) VALUES ('users', 0)")
+    c.execute('''CREATE TRIGGER IF NOT EXISTS users_cache_update
+                 AFTER UPDATE OF username, role, ban_until, avatar_ext, avatar_version, uuid ON users
+                 BEGIN UPDATE cache_generations SET generation = generation + 1 WHERE name = 'users'; END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS users_cache_delete AFTER DELETE ON users
+                 BEGIN UPDATE cache_generations SET generation = generation + 1 WHERE name = 'users'; END''')
+    # NOCASE index serves exact and prefix username lookups
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users(username COLLATE NOCASE)')
     conn.commit()
+
+    # Trigram index for substring username search; rowid mirrors users.id
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = 'users_fts'")
+    users_fts_existed = c.fetchone() is not None
+    try:
+        c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(username, tokenize='trigram')")
+        if not users_fts_existed:
+            c.execute('INSERT INTO users_fts (rowid, username) SELECT id, username FROM users')
+        conn.commit()
+    except sqlite3.OperationalError:
+        logging.warning('SQLite lacks the FTS5 trigram tokenizer; substring user search falls back to LIKE')
+        USER_FTS = False
     
     # Create posts table for announcements
     c.execute('''CREATE TABLE IF NOT EXISTS posts (
@@ -113,112 +614,1443 @@ def init_db():
         created_at INTEGER NOT NULL,
         UNIQUE(username, filename)
     )''')
+    c.execute("PRAGMA table_info(packages)")
+    package_cols = [r[1] for r in c.fetchall()]
+    if 'sha256' not in package_cols:
+        c.execute("ALTER TABLE packages ADD COLUMN sha256 TEXT DEFAULT ''")
+        conn.commit()
+        # move existing packages into the blob store
+        c.execute('SELECT id, username, filename FROM packages')
+        for package_id, username, filename in c.fetchall():
+            filepath = os.path.join(PUBLIC_DIR, username, filename)
+            if os.path.isfile(filepath):
+                c.execute('UPDATE packages SET sha256 = ? WHERE id = ?', (share_public_blob(filepath), package_id))
+    c.execute('CREATE INDEX IF NOT EXISTS idx_packages_sha256 ON packages(sha256)')
+    # manifest fields parsed once at publish time
+    metadata_added = False
+    for field in PACKAGE_META_FIELDS:
+        if field not in package_cols:
+            c.execute(f"ALTER TABLE packages ADD COLUMN {field} TEXT DEFAULT ''")
+            metadata_added = True
+    c.execute('''CREATE TABLE IF NOT EXISTS package_dependencies (
+        package_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        dependency TEXT NOT NULL,
+        dependency_name TEXT NOT NULL,
+        PRIMARY KEY (package_id, position)
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_package_dependencies_name ON package_dependencies(dependency_name)')
+    # indexes backing the sortable /packages listing
+    c.execute('CREATE INDEX IF NOT EXISTS idx_packages_name_nocase ON packages(name COLLATE NOCASE)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_packages_created_at ON packages(created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_packages_size ON packages(size)')
+    # normalized name (see normalize_package_name); canonical marks the one package that owns it
+    names_added = 'name_key' not in package_cols
+    if names_added:
+        c.execute('ALTER TABLE packages ADD COLUMN name_key TEXT')
+        c.execute('ALTER TABLE packages ADD COLUMN canonical INTEGER NOT NULL DEFAULT 0')
+        c.execute('SELECT id, name FROM packages ORDER BY id')
+        owners = {}
+        for package_id, name in c.fetchall():
+            owners.setdefault(normalize_package_name(name), []).append(package_id)
+        c.executemany('UPDATE packages SET name_key = ?, canonical = ? WHERE id = ?',
+                      [(key, int(i == 0), package_id) for key, ids in owners.items() for i, package_id in enumerate(ids)])
+        for key, ids in owners.items():
+            if len(ids) > 1:
+                logging.warning('package name %r is claimed by %d packages; the first registered keeps it', key, len(ids))
+    c.execute('CREATE INDEX IF NOT EXISTS idx_packages_name_key ON packages(name_key)')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_packages_canonical_name ON packages(name_key) WHERE canonical = 1')
     conn.commit()
-    conn.close()
+
+    # Every published (name, version), pointing at its immutable blob. packages holds the current
+    # file per (username, filename); this keeps the versions it replaced resolvable.
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = 'package_versions'")
+    versions_existed = c.fetchone() is not None
+    c.execute('''CREATE TABLE IF NOT EXISTS package_versions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        name_key TEXT NOT NULL,
+        version TEXT NOT NULL,
+        major INTEGER,
+        minor INTEGER,
+        patch INTEGER,
+        prerelease TEXT NOT NULL DEFAULT '',
+        username TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        sha256 TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created_at INTEGER NOT NULL
+    )''')
+    c.execute('PRAGMA table_info(package_versions)')
+    if 'name_key' not in [r[1] for r in c.fetchall()]:
+        # indexed by case-insensitive name before names were normalized
+        c.execute("ALTER TABLE package_versions ADD COLUMN name_key TEXT NOT NULL DEFAULT ''")
+        c.execute('SELECT id, name FROM package_versions')
+        c.executemany('UPDATE package_versions SET name_key = ? WHERE id = ?',
+                      [(normalize_package_name(name), version_id) for version_id, name in c.fetchall()])
+        # only the package that owns a name publishes versions under it
+        c.execute('DELETE FROM package_versions WHERE NOT EXISTS (SELECT 1 FROM packages p WHERE p.canonical = 1 '
+                  'AND p.username = package_versions.username AND p.filename = package_versions.filename)')
+        c.execute('DELETE FROM package_versions WHERE id NOT IN (SELECT MIN(id) FROM package_versions GROUP BY name_key, version)')
+        c.execute('DROP INDEX IF EXISTS idx_package_versions_name_version')
+        c.execute('DROP INDEX IF EXISTS idx_package_versions_semver')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_package_versions_key_version ON package_versions(name_key, version)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_package_versions_key_semver '
+              'ON package_versions(name_key, major DESC, minor DESC, patch DESC)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_package_versions_sha256 ON package_versions(sha256)')
+    conn.commit()
+
+    # Last seen mtime of each PUBLIC_DIR/<user> directory, so startup sync can skip unchanged ones
+    c.execute('''CREATE TABLE IF NOT EXISTS package_dirs (
+        username TEXT PRIMARY KEY,
+        mtime_ns INTEGER NOT NULL
+    )''')
+
+    # Append-only publish log; its generation numbers version /api/index
+    c.execute('''CREATE TABLE IF NOT EXISTS package_changes (
+        generation INTEGER PRIMARY KEY AUTOINCREMENT,
+        action TEXT NOT NULL,
+        username TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        changed_at INTEGER NOT NULL
+    )''')
+    conn.commit()
+
+    # Background job queue (see enqueue_job); a running job whose lease expires is picked up again
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL,
+        run_after REAL NOT NULL,
+        lease_until REAL,
+        result TEXT,
+        last_error TEXT,
+        created_by TEXT,
+        created_at INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, run_after)')
+    conn.commit()
+
+    # Review queue for member uploads; at most one pending row per submitted file
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = 'submissions'")
+    submissions_existed = c.fetchone() is not None
+    c.execute('''CREATE TABLE IF NOT EXISTS submissions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        sha256 TEXT,
+        submitted_at INTEGER NOT NULL,
+        name TEXT,
+        version TEXT,
+        description TEXT,
+        author TEXT,
+        dependencies TEXT,
+        manifest TEXT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        reviewed_by TEXT,
+        reviewed_at INTEGER,
+        job_id INTEGER
+    )''')
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_submissions_pending ON submissions (username, filename) "
+              "WHERE status = 'pending'")
+    c.execute('CREATE INDEX IF NOT EXISTS idx_submissions_status ON submissions (status, submitted_at)')
+    conn.commit()
+    if not submissions_existed and os.path.isdir(SUBMISSIONS_DIR):
+        # files queued before the table existed
+        for uname in sorted(os.listdir(SUBMISSIONS_DIR)):
+            udir = os.path.join(SUBMISSIONS_DIR, uname)
+            if os.path.isdir(udir):
+                for fn in sorted(os.listdir(udir)):
+                    if allowed_file(fn):
+                        record_submission(uname, fn)
+
+    # Full-text index over package metadata; rowid mirrors packages.id
+    c.execute("SELECT sql FROM sqlite_master WHERE name = 'packages_fts'")
+    row = c.fetchone()
+    fts_existed = row is not None
+    try:
+        if fts_existed and 'prefix' not in row[0]:
+            # created before the prefix index; rebuilt from the packages rows below
+            c.execute('DROP TABLE packages_fts')
+            fts_existed = False
+        # prefix indexes keep short last-word prefixes ("1", "ab") from expanding into
+        # thousands of terms at query time
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS packages_fts USING fts5(
+            name, username, author, description, dependencies, prefix='1 2 3'
+        )''')
+        conn.commit()
+    except sqlite3.OperationalError:
+        logging.warning('SQLite was built without FTS5; package search falls back to name matching')
+        PACKAGE_FTS = False
     
-    # Sync packages table with filesystem on startup
-    sync_packages_db()
+    # Sync packages table with filesystem on startup (or run `flask sync-packages` offline)
+    if SYNC_ON_STARTUP:
+        sync_packages_db()
+    if metadata_added or names_added or (PACKAGE_FTS and not fts_existed):
+        # names_added: dependency rows are keyed by the normalized name too
+        rebuild_package_metadata()
+    c = conn.cursor()
+    c.execute('SELECT 1 FROM package_versions LIMIT 1')
+    if not versions_existed or c.fetchone() is None:
+        # only now: on a database that predates the metadata columns, packages.version is
+        # filled in by the rebuild above. An empty table is refilled too, which repairs
+        # databases upgraded before the backfill ran at this point.
+        c.execute("SELECT name, version, username, filename, sha256, size, created_at FROM packages "
+                  "WHERE canonical = 1 AND version IS NOT NULL AND version != '' AND sha256 != ''")
+        _record_package_versions(c, c.fetchall())
+        conn.commit()
+    # don't keep the import-time connection around; request handlers use the pool
+    release_thread_db()
 
 
-def sync_packages_db():
-    """Sync the packages database table with the filesystem."""
+# set LEAF_SYNC_ON_STARTUP=false to skip reconciliation on import and run `flask sync-packages` instead
+SYNC_ON_STARTUP = os.environ.get('LEAF_SYNC_ON_STARTUP', 'true').lower() == 'true'
+
+
+def sync_packages_db(full=False):
+    """Sync the packages database table with the filesystem.
+
+    Only user directories whose mtime changed since the last sync are listed (all of
+    them when full is set or nothing has been recorded yet). Row changes are applied
+    in a single transaction. Returns counts of directories scanned and rows changed.
+    """
+    result = {'dirs': 0, 'scanned': 0, 'added': 0, 'removed': 0}
     if not os.path.isdir(PUBLIC_DIR):
-        return
+        return result
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
-    # Get all packages currently in DB
-    c.execute('SELECT username, filename FROM packages')
-    db_packages = set((r[0], r[1]) for r in c.fetchall())
+    c.execute('SELECT username, mtime_ns FROM package_dirs')
+    dir_mtimes = dict(c.fetchall())
+    if not dir_mtimes:
+        full = True
+    c.execute('SELECT DISTINCT username FROM packages')
+    db_users = set(r[0] for r in c.fetchall())
     
-    # Get all packages on filesystem
-    fs_packages = set()
+    # One stat per user directory; mtimes are taken before listing so a concurrent
+    # publish is picked up again on the next run
+    fs_dirs = {}
     for username in os.listdir(PUBLIC_DIR):
-        user_dir = os.path.join(PUBLIC_DIR, username)
-        if not os.path.isdir(user_dir):
+        try:
+            st = os.stat(os.path.join(PUBLIC_DIR, username))
+        except OSError:
             continue
-        for fn in os.listdir(user_dir):
-            if allowed_file(fn):
-                fs_packages.add((username, fn))
+        if stat.S_ISDIR(st.st_mode):
+            fs_dirs[username] = st.st_mtime_ns
+    result['dirs'] = len(fs_dirs)
+    changed = [u for u, mtime in fs_dirs.items() if full or dir_mtimes.get(u) != mtime]
+    gone = (db_users | set(dir_mtimes)) - set(fs_dirs)
+    result['scanned'] = len(changed)
+    
+    to_remove = []
+    to_add = []
+    for username in gone:
+        c.execute('SELECT filename FROM packages WHERE username = ?', (username,))
+        to_remove.extend((username, r[0]) for r in c.fetchall())
+    for username in changed:
+        c.execute('SELECT filename FROM packages WHERE username = ?', (username,))
+        db_files = set(r[0] for r in c.fetchall())
+        try:
+            fs_files = set(fn for fn in os.listdir(os.path.join(PUBLIC_DIR, username)) if allowed_file(fn))
+        except OSError:
+            continue
+        to_remove.extend((username, fn) for fn in db_files - fs_files)
+        to_add.extend((username, fn) for fn in fs_files - db_files)
     
     # Remove packages from DB that no longer exist on filesystem
-    to_remove = db_packages - fs_packages
+    orphaned = set()
+    freed_names = set()
     for username, filename in to_remove:
-        c.execute('DELETE FROM packages WHERE username = ? AND filename = ?', (username, filename))
+        c.execute('SELECT sha256, name_key, canonical FROM packages WHERE username = ? AND filename = ?', (username, filename))
+        row = c.fetchone()
+        if row and row[0]:
+            orphaned.add(row[0])
+        if row and row[2]:
+            freed_names.add(row[1])
+        c.execute('SELECT sha256 FROM package_versions WHERE username = ? AND filename = ?', (username, filename))
+        orphaned.update(r[0] for r in c.fetchall() if r[0])
+    c.executemany('DELETE FROM package_dependencies WHERE package_id IN '
+                  '(SELECT id FROM packages WHERE username = ? AND filename = ?)', to_remove)
+    if PACKAGE_FTS:
+        c.executemany('DELETE FROM packages_fts WHERE rowid IN (SELECT id FROM packages WHERE username = ? AND filename = ?)',
+                      to_remove)
+    c.executemany('DELETE FROM packages WHERE username = ? AND filename = ?', to_remove)
+    # as in unregister_package: versions published from a file go with it
+    c.executemany('DELETE FROM package_versions WHERE username = ? AND filename = ?', to_remove)
+    _log_package_changes(c, 'remove', to_remove)
+    _promote_name_owners(c, freed_names)
     
-    # Add packages to DB that exist on filesystem but not in DB
-    to_add = fs_packages - db_packages
+    # Add packages to DB that exist on filesystem but not in DB. They're registered in
+    # (username, filename) order, so when several share a free name the same one claims it
+    # on every run; mtimes can't decide that, a deduplicated file carries its blob's.
+    found = []
+    to_add.sort()
     for username, filename in to_add:
-        filepath = os.path.join(PUBLIC_DIR, username, filename)
         try:
-            stats = os.stat(filepath)
-            size = stats.st_size
-            created_at = int(stats.st_mtime)
+            stats = os.stat(os.path.join(PUBLIC_DIR, username, filename))
+            # a file linked to a blob (nlink > 1) has the blob's mtime, not its own
+            created_at = int(stats.st_mtime) if stats.st_nlink == 1 else int(time.time())
+            found.append((created_at, username, filename, stats.st_size))
         except OSError:
-            size = 0
-            created_at = int(time.time())
+            found.append((int(time.time()), username, filename, 0))
+    rows = []
+    manifests = []
+    claimed = set()
+    for created_at, username, filename, size in found:
+        filepath = os.path.join(PUBLIC_DIR, username, filename)
         name = filename.rsplit('.', 1)[0]
-        c.execute('INSERT OR IGNORE INTO packages (name, filename, username, size, created_at) VALUES (?, ?, ?, ?, ?)',
-                  (name, filename, username, size, created_at))
+        try:
+            digest = share_public_blob(filepath)
+        except OSError:
+            digest = ''
+        manifest = manifest_cache.get(filepath)
+        manifests.append(manifest)
+        name_key = normalize_package_name(name)
+        canonical = name_key not in claimed and _name_owner(c, name_key) is None
+        if canonical:
+            claimed.add(name_key)
+        rows.append((name, filename, username, size, created_at, digest, name_key, int(canonical))
+                    + _package_meta_values(manifest))
+    c.executemany(f'INSERT OR IGNORE INTO packages (name, filename, username, size, created_at, sha256, name_key, canonical, '
+                  f'{PACKAGE_META_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?{", ?" * len(PACKAGE_META_FIELDS)})', rows)
+    _log_package_changes(c, 'add', to_add)
+    for row, manifest in zip(rows, manifests):
+        name, filename, username = row[:3]
+        c.execute('SELECT id FROM packages WHERE username = ? AND filename = ?', (username, filename))
+        _store_package_metadata(c, c.fetchone()[0], name, username, manifest)
+    _record_package_versions(c, [(row[0], manifest['version'], row[2], row[1], row[5], row[3], row[4])
+                                 for row, manifest in zip(rows, manifests) if row[7]])
+    result['added'] = len(to_add)
+    result['removed'] = len(to_remove)
+
+    c.executemany('INSERT OR REPLACE INTO package_dirs (username, mtime_ns) VALUES (?, ?)',
+                  [(u, fs_dirs[u]) for u in changed])
+    c.executemany('DELETE FROM package_dirs WHERE username = ?', [(u,) for u in gone])
+
+    # keep the change log bounded; older /api/index?since= values get a full snapshot
+    c.execute('DELETE FROM package_changes WHERE generation <= '
+              '(SELECT MAX(generation) FROM package_changes) - ?', (PACKAGE_CHANGES_RETAINED,))
+    conn.commit()
+    for digest in orphaned:
+        _collect_blob(digest)
+    return result
+
+
+@app.cli.command('sync-packages')
+@click.option('--full', is_flag=True, help='List every user directory, ignoring recorded mtimes.')
+def sync_packages_command(full):
+    """Reconcile the packages table with storage/public."""
+    result = sync_packages_db(full=full)
+    click.echo(f"{result['scanned']}/{result['dirs']} directories scanned, "
+               f"{result['added']} added, {result['removed']} removed")
+
+
+PACKAGE_CHANGES_RETAINED = 50000
+
+
+def _log_package_changes(c, action, pairs):
+    now = int(time.time())
+    c.executemany('INSERT INTO package_changes (action, username, filename, changed_at) VALUES (?, ?, ?, ?)',
+                  [(action, username, filename, now) for username, filename in pairs])
+
+
+def _log_package_change(c, action, username, filename):
+    _log_package_changes(c, action, [(username, filename)])
+
+
+# manifest fields copied into packages columns at publish time
+PACKAGE_META_FIELDS = ('version', 'description', 'author', 'license', 'homepage', 'repository')
+PACKAGE_META_COLUMNS = ', '.join(PACKAGE_META_FIELDS)
+# ranking weights for bm25(), in packages_fts column order
+PACKAGE_FTS_WEIGHTS = (10.0, 4.0, 2.0, 1.0, 1.0)
+# bm25 scores every match before LIMIT applies; queries matching more packages than this
+# list name matches first, newest first, which FTS5 can stop reading early
+PACKAGE_SEARCH_RANK_LIMIT = 500
+PACKAGE_FTS = True
+
+
+PACKAGE_NAME_SEPARATORS_RE = re.compile(r'[-_.]+')
+
+
+def normalize_package_name(name):
+    """Canonical form of a package name: case-folded, runs of - _ . as one '-', none at the ends.
+
+    Names that normalize alike are the same package: Foo_Bar, foo-bar and FOO.bar all
+    resolve through packages.name_key, and only one published package can own each key.
+    """
+    return PACKAGE_NAME_SEPARATORS_RE.sub('-', name.strip()).strip('-').lower()
+
+
+def split_dependency(dependency):
+    """(name, constraint) of a dependency entry ("foo >= 1.2" -> ("foo", ">= 1.2"), "foo@1.2" -> ("foo", "1.2"))."""
+    parts = re.split(r'([\s<>=!~^@,])', dependency.strip(), maxsplit=1)
+    return parts[0], ''.join(parts[1:]).strip().lstrip('@').strip()
+
+
+def dependency_name(dependency):
+    """Normalized package name of a dependency entry ("Foo_Bar >= 1.2" -> "foo-bar")."""
+    return normalize_package_name(split_dependency(dependency)[0])
+
+
+def _name_owner(c, name_key):
+    """(username, filename) of the package that owns name_key, or None."""
+    c.execute('SELECT username, filename FROM packages WHERE name_key = ? AND canonical = 1', (name_key,))
+    return c.fetchone()
+
+
+def _promote_name_owners(c, name_keys):
+    """Hand each ownerless name to the earliest registered package left (lowest id)."""
+    for name_key in name_keys:
+        if _name_owner(c, name_key) is None:
+            c.execute('UPDATE packages SET canonical = 1 WHERE id = '
+                      '(SELECT id FROM packages WHERE name_key = ? ORDER BY id LIMIT 1) '
+                      'RETURNING name, version, username, filename, sha256, size, created_at', (name_key,))
+            _record_package_versions(c, c.fetchall())
+
+
+def package_name_conflict(username, filename):
+    """Message if (username, filename) may not be published because another package owns its name.
+
+    The first package registered under a normalized name owns it; only that same
+    username/filename can publish it again. Files that show up on disk under a taken
+    name are still registered, but stay reachable only by their user path.
+    """
+    name = filename.rsplit('.', 1)[0]
+    owner = _name_owner(get_db().cursor(), normalize_package_name(name))
+    if owner and tuple(owner) != (username, filename):
+        return f'The package name {name} is already taken by {owner[0]}/{owner[1]}'
+    return None
+
+
+def _package_meta_values(manifest):
+    return tuple(manifest[field] or '' for field in PACKAGE_META_FIELDS)
+
+
+def _store_package_metadata(c, package_id, name, username, manifest):
+    """Write a package's dependency rows and full-text entry from its parsed manifest."""
+    c.execute('DELETE FROM package_dependencies WHERE package_id = ?', (package_id,))
+    c.executemany('INSERT INTO package_dependencies (package_id, position, dependency, dependency_name) VALUES (?, ?, ?, ?)',
+                  [(package_id, i, dep, dependency_name(dep)) for i, dep in enumerate(manifest['dependencies'])])
+    if not PACKAGE_FTS:
+        return
+    names = name if not manifest['name'] or manifest['name'] == name else f"{name} {manifest['name']}"
+    c.execute('DELETE FROM packages_fts WHERE rowid = ?', (package_id,))
+    c.execute('INSERT INTO packages_fts (rowid, name, username, author, description, dependencies) VALUES (?, ?, ?, ?, ?, ?)',
+              (package_id, names, username, manifest['author'] or '', manifest['description'] or '',
+               ' '.join(manifest['dependencies'])))
+
+
+def _drop_package_metadata(c, username, filename):
+    c.execute('DELETE FROM package_dependencies WHERE package_id IN (SELECT id FROM packages WHERE username = ? AND filename = ?)',
+              (username, filename))
+    if not PACKAGE_FTS:
+        return
+    c.execute('DELETE FROM packages_fts WHERE rowid IN (SELECT id FROM packages WHERE username = ? AND filename = ?)',
+              (username, filename))
+
+
+def rebuild_package_metadata():
+    """Re-parse every registered package's manifest into its columns, dependencies and search entry."""
+    conn = get_db()
+    c = conn.cursor()
+    if PACKAGE_FTS:
+        c.execute('DELETE FROM packages_fts')
+    c.execute('SELECT id, name, username, filename FROM packages')
+    for package_id, name, username, filename in c.fetchall():
+        manifest = manifest_cache.get(os.path.join(PUBLIC_DIR, username, filename))
+        c.execute(f'UPDATE packages SET {", ".join(f + " = ?" for f in PACKAGE_META_FIELDS)} WHERE id = ?',
+                  _package_meta_values(manifest) + (package_id,))
+        _store_package_metadata(c, package_id, name, username, manifest)
+    conn.commit()
+
+
+def register_package(username, filename, sha256=None, commit=True):
+    """Register a package in the database when uploaded/approved.
+
+    Pass commit=False to register several packages in the caller's transaction.
+    """
+    filepath = os.path.join(PUBLIC_DIR, username, filename)
+    # the public file may be a link to a blob stored long ago, so its mtime isn't the publish time
+    created_at = int(time.time())
+    try:
+        size = os.stat(filepath).st_size
+    except OSError:
+        size = 0
+    if sha256 is None:
+        try:
+            sha256 = share_public_blob(filepath)
+        except OSError:
+            sha256 = ''
+    manifest = manifest_cache.get(filepath)
     
+    name = filename.rsplit('.', 1)[0]
+    name_key = normalize_package_name(name)
+    conn = get_db()
+    c = conn.cursor()
+    # the name stays with its current owner; anyone else's file is registered but not canonical
+    owner = _name_owner(c, name_key)
+    canonical = owner is None or tuple(owner) == (username, filename)
+    # REPLACE assigns a new id, so drop the old dependency/search rows first
+    _drop_package_metadata(c, username, filename)
+    c.execute(f'INSERT OR REPLACE INTO packages (name, filename, username, size, created_at, sha256, name_key, canonical, '
+              f'{PACKAGE_META_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?{", ?" * len(PACKAGE_META_FIELDS)})',
+              (name, filename, username, size, created_at, sha256, name_key, int(canonical)) + _package_meta_values(manifest))
+    _store_package_metadata(c, c.lastrowid, name, username, manifest)
+    if canonical:
+        _record_package_versions(c, [(name, manifest['version'], username, filename, sha256, size, created_at)])
+    _log_package_change(c, 'add', username, filename)
+    if sha256:
+        # the write above holds the database lock, which _collect_blob takes too: a blob it
+        # removed before this row existed is put back from the public file
+        try:
+            store_blob(filepath, sha256)
+        except OSError:
+            pass
+    if commit:
+        conn.commit()
+
+
+def unregister_package(username, filename):
+    """Remove a package from the database when deleted, along with every version published from it."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT sha256 FROM packages WHERE username = ? AND filename = ? '
+              'UNION SELECT sha256 FROM package_versions WHERE username = ? AND filename = ?',
+              (username, filename, username, filename))
+    digests = [r[0] for r in c.fetchall() if r[0]]
+    _drop_package_metadata(c, username, filename)
+    c.execute('DELETE FROM packages WHERE username = ? AND filename = ?', (username, filename))
+    if c.rowcount:
+        _log_package_change(c, 'remove', username, filename)
+    c.execute('DELETE FROM package_versions WHERE username = ? AND filename = ?', (username, filename))
+    _promote_name_owners(c, [normalize_package_name(filename.rsplit('.', 1)[0])])
     conn.commit()
-    conn.close()
+    for digest in digests:
+        _collect_blob(digest)
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def blob_path(digest):
+    return os.path.join(BLOBS_DIR, digest[:2], digest)
+
+
+def _link_or_copy(src, dst):
+    # hard links share one copy on disk; fall back to copying across filesystems
+    try:
+        os.link(src, dst)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def store_blob(path, digest=None, consume=False):
+    """Make sure the content of path is in the blob store; returns its sha256.
+
+    Identical content is stored once. Blobs are read-only and never rewritten in place.
+    Only a path the caller is about to remove (consume=True) is linked into the store;
+    anything else is copied, so making the blob read-only can't touch the original.
+    Public files found on disk go through share_public_blob instead.
+    """
+    digest = digest or file_sha256(path)
+    dst = blob_path(digest)
+    if not os.path.exists(dst):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = f'{dst}.{uuid.uuid4().hex}.tmp'
+        if consume:
+            _link_or_copy(path, tmp)
+        else:
+            shutil.copyfile(path, tmp)
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, dst)
+    return digest
+
+
+def share_public_blob(path):
+    """Put a public file that was placed outside publishing into the blob store; returns its sha256.
+
+    Unlike store_blob, the file and its blob end up sharing one inode: the file itself is
+    linked into the store (and so becomes read-only like every published file), or, when
+    its content is already stored, replaced by a link to that blob. Across filesystems it
+    is copied and left alone.
+    """
+    os.makedirs(BLOBS_DIR, exist_ok=True)
+    tmp = os.path.join(BLOBS_DIR, f'{uuid.uuid4().hex}.tmp')
+    try:
+        os.link(path, tmp)
+        linked = True
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(path, tmp)
+        linked = False
+    try:
+        # hashed after the chmod, so the digest matches what the blob will hold
+        os.chmod(tmp, 0o444)
+        digest = file_sha256(tmp)
+        dst = blob_path(digest)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if not os.path.exists(dst):
+            os.replace(tmp, dst)
+            return digest
+        if linked and not os.path.samefile(dst, path):
+            # drop the duplicate: point the public path at the stored copy
+            public_tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+            os.link(dst, public_tmp)
+            os.replace(public_tmp, path)
+            manifest_cache.invalidate(path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return digest
+
+
+def _collect_blob(digest):
+    """Remove a blob once no package or version row refers to it.
+
+    The check and the unlink happen under the database write lock, so a publish
+    can't register the digest in between (see register_package).
+    """
+    conn = get_db()
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        c = conn.cursor()
+        c.execute('SELECT 1 FROM packages WHERE sha256 = ? UNION ALL SELECT 1 FROM package_versions WHERE sha256 = ? LIMIT 1',
+                  (digest, digest))
+        if not c.fetchone():
+            try:
+                os.remove(blob_path(digest))
+            except OSError:
+                pass
+    finally:
+        conn.commit()
+
+
+class PublishRejected(Exception):
+    """The package can't be published as asked; running the publish again won't help."""
+
+
+def publish_package_file(src, username, filename, digest=None):
+    """Publish src as PUBLIC_DIR/<username>/<filename>, backed by the blob store.
+
+    src is consumed. The public path is swapped in with an atomic rename, so it always
+    names either the previous or the new content. Pass digest when the caller already
+    hashed src. Returns the sha256; raises PublishRejected if the publish conflicts
+    with what is already published.
+    """
+    (digest, error), = _publish_files([(src, username, filename, digest)])
+    if error:
+        raise error
+    return digest
+
+
+def publish_package_files(items):
+    """Publish many (src, username, filename, digest) items; the registrations share one transaction.
+
+    Returns one (sha256, error) pair per item, in order. An item whose file can't be
+    placed, or that is rejected, is reported and skipped; a database error rolls back
+    the batch and raises.
+    """
+    return [(digest, str(error) if error else None) for digest, error in _publish_files(items)]
+
+
+def _publish_files(items):
+    """publish_package_files() with the errors as exceptions."""
+    results = []
+    for src, username, filename, digest in items:
+        try:
+            results.append((store_blob(src, digest, consume=True), None))
+        except OSError as e:
+            results.append((None, e))
+    conn = get_db()
+    if conn.in_transaction:
+        conn.commit()
+    # checked and registered under the write lock, so a publish that lands in between
+    # can't slip the same version or name past the check
+    conn.execute('BEGIN IMMEDIATE')
+    placed, unused = [], set()
+    try:
+        for i, (src, username, filename, _) in enumerate(items):
+            digest = results[i][0]
+            if not digest:
+                continue
+            # ownership too: another package may have taken the name since this was queued
+            conflict = publish_conflict(src, username, filename, digest)
+            if conflict:
+                results[i] = (None, PublishRejected(conflict))
+                unused.add(digest)
+                continue
+            try:
+                previous = _place_public_file(src, username, filename, digest)
+            except OSError as e:
+                results[i] = (None, e)
+                unused.add(digest)
+                continue
+            register_package(username, filename, digest, commit=False)
+            placed.append((src, digest, previous))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    # src goes last so a publish that fails part way can simply be run again
+    for src, digest, previous in placed:
+        try:
+            os.remove(src)
+        except OSError:
+            pass
+    # blobs this replaced, or stored for items that didn't make it; still-used ones are kept
+    for digest in unused | {previous for _, digest, previous in placed if previous and previous != digest}:
+        _collect_blob(digest)
+    return results
+
+
+def _place_public_file(src, username, filename, digest):
+    """Swap blob digest in at the public path; returns the sha256 it replaced ('' if none)."""
+    dest_dir = os.path.join(PUBLIC_DIR, username)
+    os.makedirs(dest_dir, exist_ok=True)
+    dest = os.path.join(dest_dir, filename)
+    c = get_db().cursor()
+    c.execute('SELECT sha256 FROM packages WHERE username = ? AND filename = ?', (username, filename))
+    row = c.fetchone()
+    previous = row[0] if row else ''
+    tmp = f'{dest}.{uuid.uuid4().hex}.tmp'
+    try:
+        _link_or_copy(blob_path(digest), tmp)
+    except FileNotFoundError:
+        # collected by a concurrent unpublish after store_blob saw it; store it again
+        store_blob(src, digest, consume=True)
+        _link_or_copy(blob_path(digest), tmp)
+    os.replace(tmp, dest)
+    manifest_cache.invalidate(dest)
+    return previous
+
+
+# --- background jobs ---------------------------------------------------------------------------------
+# Jobs live in the jobs table, so they survive restarts and any process can run them.
+# Workers claim a job by leasing it; a crash mid-job just lets the lease run out.
+JOB_WORKERS = int(os.environ.get('LEAF_JOB_WORKERS', '2'))  # 0 runs jobs inline in the request
+JOB_MAX_ATTEMPTS = int(os.environ.get('LEAF_JOB_MAX_ATTEMPTS', '5'))
+JOB_LEASE_SECONDS = 300
+JOB_POLL_SECONDS = 5.0
+JOB_RETENTION_SECONDS = 7 * 24 * 3600  # finished jobs are pruned after this
+JOB_PRUNE_SECONDS = JOB_RETENTION_SECONDS / 10
+JOB_STATUSES = ('queued', 'running', 'done', 'failed')
+JOB_FIELDS = ('id', 'kind', 'payload', 'status', 'attempts', 'max_attempts', 'run_after',
+              'result', 'last_error', 'created_by', 'created_at', 'updated_at')
+
+JOB_HANDLERS = {}
+_job_wakeup = threading.Condition()
+_job_workers_lock = threading.Lock()
+_job_workers_pid = None
+_jobs_pruned_at = 0.0
+
+
+class JobFailed(Exception):
+    """Raised by a handler to fail its job right away instead of retrying it."""
+
+
+def job_handler(kind):
+    """Register fn(payload) -> JSON-able result as the handler for jobs of this kind."""
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+def enqueue_job(kind, payload, created_by=None, max_attempts=None):
+    """Queue a job and return its id. With LEAF_JOB_WORKERS=0 it runs before returning."""
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f'unknown job kind: {kind}')
+    now = time.time()
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('INSERT INTO jobs (kind, payload, max_attempts, run_after, created_by, created_at, updated_at) '
+              'VALUES (?, ?, ?, ?, ?, ?, ?)',
+              (kind, json.dumps(payload), max_attempts or JOB_MAX_ATTEMPTS, now, created_by, int(now), int(now)))
+    conn.commit()
+    job_id = c.lastrowid
+    if JOB_WORKERS <= 0:
+        while run_next_job():
+            pass
+    else:
+        ensure_job_workers()
+        with _job_wakeup:
+            _job_wakeup.notify()
+    return job_id
+
+
+JOB_DUE = "(status = 'queued' AND run_after <= ?) OR (status = 'running' AND lease_until < ?)"
+
+
+def _claim_job():
+    now = time.time()
+    conn = get_db()
+    c = conn.cursor()
+    # idle polls stay read-only; only take the write lock when something is due
+    c.execute(f'SELECT 1 FROM jobs WHERE {JOB_DUE} LIMIT 1', (now, now))
+    if c.fetchone() is None:
+        return None
+    c.execute(f'''UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, updated_at = ?
+                 WHERE id = (SELECT id FROM jobs WHERE {JOB_DUE} ORDER BY id LIMIT 1)
+                 RETURNING id, kind, payload, attempts, max_attempts''',
+              (now + JOB_LEASE_SECONDS, int(now), now, now))
+    row = c.fetchone()
+    conn.commit()
+    return row
+
+
+def run_next_job():
+    """Claim and run one due job; returns False when there was nothing to do."""
+    with app.app_context():
+        row = _claim_job()
+        if row is None:
+            return False
+        job_id, kind, payload, attempts, max_attempts = row
+        try:
+            result = JOB_HANDLERS[kind](json.loads(payload))
+        except Exception as e:
+            logging.exception('job %s (%s) failed on attempt %s', job_id, kind, attempts)
+            if attempts < max_attempts and not isinstance(e, JobFailed):
+                # exponential backoff: 2s, 4s, 8s, ...
+                update = ("status = 'queued', run_after = ?", time.time() + 2 ** attempts)
+            else:
+                update = ("status = 'failed', run_after = ?", time.time())
+            get_db().execute(f'UPDATE jobs SET {update[0]}, lease_until = NULL, last_error = ?, updated_at = ? WHERE id = ?',
+                             (update[1], f'{type(e).__name__}: {e}', int(time.time()), job_id))
+        else:
+            get_db().execute("UPDATE jobs SET status = 'done', lease_until = NULL, result = ?, last_error = NULL, "
+                             'updated_at = ? WHERE id = ?', (json.dumps(result), int(time.time()), job_id))
+        get_db().commit()
+        return True
+
+
+def _job_sources(payload):
+    """Staged files a publish payload still needs."""
+    return [item['src'] for item in payload.get('items', [payload]) if item.get('src')]
+
+
+def _prune_jobs():
+    """Drop old finished jobs and staged files that no job can use any more.
+
+    A failed job keeps its staged file for JOB_RETENTION_SECONDS so it can be retried.
+    Uploads left behind by a killed request are dropped after UPLOAD_STAGING_MAX_AGE.
+    """
+    global _jobs_pruned_at
+    now = time.time()
+    if now - _jobs_pruned_at < JOB_PRUNE_SECONDS:
+        return
+    _jobs_pruned_at = now
+    cutoff = int(now - JOB_RETENTION_SECONDS)
+    with app.app_context():
+        conn = get_db()
+        conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (cutoff,))
+        conn.commit()
+        c = conn.cursor()
+        c.execute("SELECT payload FROM jobs WHERE kind IN ('publish', 'publish_batch') AND status != 'done'")
+        needed = {os.path.basename(src) for (payload,) in c.fetchall() for src in _job_sources(json.loads(payload))}
+    try:
+        names = os.listdir(STAGING_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(STAGING_DIR, name)
+        try:
+            # ctime is when stage_for_publish renamed it; give its job time to be inserted
+            if name.endswith('.pending') and name not in needed and os.stat(path).st_ctime < now - JOB_LEASE_SECONDS:
+                os.remove(path)
+            # mtime is the last chunk written; a live upload keeps it fresh
+            elif name.endswith('.upload') and os.stat(path).st_mtime < now - UPLOAD_STAGING_MAX_AGE:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _job_worker():
+    while True:
+        try:
+            if run_next_job():
+                continue
+            _prune_jobs()
+        except Exception:
+            logging.exception('job worker error')
+        with _job_wakeup:
+            _job_wakeup.wait(JOB_POLL_SECONDS)
+
+
+def ensure_job_workers():
+    """Start this process's worker threads (once per process, so forked servers get their own)."""
+    global _job_workers_pid
+    if JOB_WORKERS <= 0 or _job_workers_pid == os.getpid():
+        return
+    with _job_workers_lock:
+        if _job_workers_pid == os.getpid():
+            return
+        for i in range(JOB_WORKERS):
+            threading.Thread(target=_job_worker, name=f'leaf-job-{i}', daemon=True).start()
+        _job_workers_pid = os.getpid()
+
+
+def _job_row(row):
+    job = dict(zip(JOB_FIELDS, row))
+    for key in ('payload', 'result'):
+        job[key] = json.loads(job[key]) if job[key] else None
+    return job
+
+
+def get_job(job_id):
+    c = get_db().cursor()
+    c.execute(f'SELECT {", ".join(JOB_FIELDS)} FROM jobs WHERE id = ?', (job_id,))
+    row = c.fetchone()
+    return _job_row(row) if row else None
+
+
+def list_jobs(status=None, limit=50):
+    c = get_db().cursor()
+    if status:
+        c.execute(f'SELECT {", ".join(JOB_FIELDS)} FROM jobs WHERE status = ? ORDER BY id DESC LIMIT ?', (status, limit))
+    else:
+        c.execute(f'SELECT {", ".join(JOB_FIELDS)} FROM jobs ORDER BY id DESC LIMIT ?', (limit,))
+    return [_job_row(r) for r in c.fetchall()]
+
+
+@app.before_request
+def start_job_workers():
+    # jobs queued before a restart, or by another process, still need a worker here
+    ensure_job_workers()
+
+
+@app.cli.command('run-jobs')
+def run_jobs_command():
+    """Run every due background job in the foreground, then exit."""
+    ran = 0
+    while run_next_job():
+        ran += 1
+    click.echo(f'ran {ran} job(s); {job_counts()}')
+
+
+def job_counts():
+    c = get_db().cursor()
+    c.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')
+    counts = dict.fromkeys(JOB_STATUSES, 0)
+    counts.update(c.fetchall())
+    return counts
+
+
+def stage_for_publish(src):
+    """Move src into STAGING_DIR (same filesystem, so a rename) and return the new path."""
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    staged = os.path.join(STAGING_DIR, f'{uuid.uuid4().hex}.pending')
+    os.replace(src, staged)
+    return staged
+
+
+def _published_digest(item):
+    """The digest a finished earlier attempt registered for a publish item whose src is gone."""
+    c = get_db().cursor()
+    c.execute('SELECT sha256 FROM packages WHERE username = ? AND filename = ?', (item['username'], item['filename']))
+    row = c.fetchone()
+    if row and row[0] and (not item.get('digest') or row[0] == item['digest']):
+        return row[0]
+    return None
+
+
+@job_handler('publish')
+def _publish_job(payload):
+    src, username, filename = payload['src'], payload['username'], payload['filename']
+    if not os.path.exists(src):
+        # an earlier attempt finished and removed src just before it could record success
+        digest = _published_digest(payload)
+        if digest:
+            return {'sha256': digest}
+        raise FileNotFoundError(src)
+    try:
+        return {'sha256': publish_package_file(src, username, filename, payload.get('digest'))}
+    except PublishRejected as e:
+        fail_submissions([(username, filename)])
+        raise JobFailed(str(e)) from e
+
+
+@job_handler('publish_batch')
+def _publish_batch_job(payload):
+    items = payload['items']
+    pending = [i for i, item in enumerate(items) if os.path.exists(item['src'])]
+    outcomes = dict(zip(pending, publish_package_files(
+        [(items[i]['src'], items[i]['username'], items[i]['filename'], items[i].get('digest')) for i in pending])))
+    results = []
+    for i, item in enumerate(items):
+        digest, error = outcomes.get(i) or (_published_digest(item), None)
+        if not digest and not error:
+            error = 'staged file is missing'
+        results.append({'username': item['username'], 'filename': item['filename'], 'sha256': digest, 'error': error})
+    fail_submissions([(r['username'], r['filename']) for r in results if r['error']])
+    return {'items': results}
+
+
+# --- submissions (member uploads awaiting review) ------------------------------------------------------
+SUBMISSION_STATUSES = ('pending', 'accepted', 'denied', 'failed')
+SUBMISSION_FIELDS = ('id', 'username', 'filename', 'size', 'sha256', 'submitted_at', 'name', 'version',
+                     'description', 'author', 'dependencies', 'status', 'reviewed_by', 'reviewed_at', 'job_id')
+SUBMISSIONS_PER_PAGE = 50
+
+
+def record_submission(username, filename, sha256=None):
+    """Add SUBMISSIONS_DIR/<username>/<filename> to the review queue, replacing an earlier pending upload.
+
+    The manifest is parsed once here so the review page never has to open the file.
+    """
+    path = os.path.join(SUBMISSIONS_DIR, username, filename)
+    manifest = parse_leaf_manifest(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("DELETE FROM submissions WHERE username = ? AND filename = ? AND status = 'pending'", (username, filename))
+    c.execute('INSERT INTO submissions (username, filename, size, sha256, submitted_at, name, version, description, '
+              'author, dependencies, manifest) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+              (username, filename, st.st_size, sha256, int(st.st_mtime), manifest['name'], manifest['version'],
+               manifest['description'], manifest['author'], '\n'.join(manifest['dependencies']), manifest['raw']))
+    conn.commit()
+    return c.lastrowid
+
+
+def _submission_row(row):
+    sub = dict(zip(SUBMISSION_FIELDS, row))
+    sub['dependencies'] = sub['dependencies'].split('\n') if sub['dependencies'] else []
+    return sub
+
+
+def list_submissions(status='pending', username=None, query=None, limit=SUBMISSIONS_PER_PAGE, offset=0):
+    """Submissions, oldest first for the pending queue and newest first otherwise."""
+    clauses, params = ['status = ?'], [status]
+    if username:
+        clauses.append('username = ? COLLATE NOCASE')
+        params.append(username)
+    if query:
+        like = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        clauses.append("(filename LIKE ? ESCAPE '\\' OR name LIKE ? ESCAPE '\\')")
+        params.extend((like, like))
+    direction = 'ASC' if status == 'pending' else 'DESC'
+    c = get_db().cursor()
+    c.execute(f'SELECT {", ".join(SUBMISSION_FIELDS)} FROM submissions WHERE {" AND ".join(clauses)} '
+              f'ORDER BY submitted_at {direction}, id {direction} LIMIT ? OFFSET ?', (*params, limit, offset))
+    return [_submission_row(r) for r in c.fetchall()]
+
+
+def get_submission(username, filename, status='pending'):
+    """The submission row for a file, including the stored manifest text."""
+    c = get_db().cursor()
+    c.execute(f'SELECT {", ".join(SUBMISSION_FIELDS)}, manifest FROM submissions '
+              'WHERE username = ? AND filename = ? AND status = ? ORDER BY id DESC LIMIT 1', (username, filename, status))
+    row = c.fetchone()
+    if not row:
+        return None
+    sub = _submission_row(row[:-1])
+    sub['manifest'] = row[-1]
+    return sub
+
+
+def close_submissions(pairs, status, reviewed_by, job_id=None):
+    """Mark the pending submissions for (username, filename) pairs accepted/denied."""
+    conn = get_db()
+    now = int(time.time())
+    conn.executemany("UPDATE submissions SET status = ?, reviewed_by = ?, reviewed_at = ?, job_id = ? "
+                     "WHERE username = ? AND filename = ? AND status = 'pending'",
+                     [(status, reviewed_by, now, job_id, username, filename) for username, filename in pairs])
+    conn.commit()
+
+
+def fail_submissions(pairs):
+    """Mark the latest accepted submission of each (username, filename) failed: its publish was refused."""
+    conn = get_db()
+    conn.executemany("UPDATE submissions SET status = 'failed' WHERE id = (SELECT id FROM submissions "
+                     "WHERE username = ? AND filename = ? AND status = 'accepted' ORDER BY id DESC LIMIT 1)", pairs)
+    conn.commit()
+
+
+def get_package_by_name(name):
+    """Find the package that owns name (compared normalized, see normalize_package_name)."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT name, filename, username, size, created_at, sha256, id, version, description '
+              'FROM packages WHERE name_key = ? AND canonical = 1', (normalize_package_name(name),))
+    row = c.fetchone()
+    if not row:
+        return None
+    return {
+        'name': row[0],
+        'filename': row[1],
+        'username': row[2],
+        'size': row[3],
+        'created_at': row[4],
+        'sha256': row[5] or '',
+        'id': row[6],
+        'version': row[7] or '',
+        'description': row[8] or ''
+    }
+
+
+# --- versions ---------------------------------------------------------------------------------------
+# Versions are parsed leniently as semver: "v1", "1.2" and "1.2.3-rc.1+build" all index;
+# anything else is stored with NULL numbers and can only be asked for verbatim.
+SEMVER_RE = re.compile(r'v?(\d+)(?:\.(\d+))?(?:\.(\d+))?(?:-([0-9A-Za-z.-]+))?(?:\+[0-9A-Za-z.-]+)?')
+CONSTRAINT_TERM_RE = re.compile(r'(\^|~|>=|<=|>|<|==|=|!=)?\s*([^\s,<>=!^~]+)')
+VERSION_FIELDS = ('name', 'version', 'username', 'filename', 'sha256', 'size', 'created_at', 'prerelease')
+
+
+def parse_semver(version):
+    """(major, minor, patch, prerelease, parts given) for a version string, or None."""
+    m = SEMVER_RE.fullmatch((version or '').strip())
+    if not m:
+        return None
+    parts = sum(1 for g in m.groups()[:3] if g is not None)
+    return int(m[1]), int(m[2] or 0), int(m[3] or 0), m[4] or '', parts
+
+
+def semver_key(major, minor, patch, prerelease):
+    """Sort key with semver precedence: 1.0.0-alpha < 1.0.0-alpha.1 < 1.0.0-beta < 1.0.0."""
+    if not prerelease:
+        return major, minor, patch, (1,)
+    ids = tuple((0, int(p), '') if p.isdigit() else (1, 0, p) for p in prerelease.split('.'))
+    return major, minor, patch, (0, ids)
+
+
+def parse_version_constraint(spec):
+    """Turn '>=1.2, <2', '^1.4', '~0.3.1', '1.2' or '*' into a list of (op, key) comparisons.
+
+    Raises ValueError for anything it can't read. A bare or = version with missing parts
+    matches the whole range it names (1.2 means >=1.2.0, <1.3.0).
+    """
+    spec = (spec or '').strip()
+    if spec in ('', '*', 'latest'):
+        return []
+    if CONSTRAINT_TERM_RE.sub('', spec).replace(',', '').strip():
+        raise ValueError(f'bad version constraint: {spec}')
+    comparisons = []
+    for term in CONSTRAINT_TERM_RE.finditer(spec):
+        op, text = term[1] or '=', term[2]
+        parsed = parse_semver(text)
+        if parsed is None:
+            raise ValueError(f'bad version in constraint: {text}')
+        major, minor, patch, pre, parts = parsed
+        low = semver_key(major, minor, patch, pre)
+        if op in ('^', '~', '=', '=='):
+            if op == '^':
+                # next release that may break: first non-zero component bumps
+                bump = 0 if major or parts == 1 else (1 if minor or parts == 2 else 2)
+            elif op == '~':
+                bump = 0 if parts == 1 else 1
+            elif parts == 3 or pre:
+                comparisons.append(('==', low))
+                continue
+            else:
+                bump = parts - 1
+            upper = [major, minor, patch]
+            upper[bump] += 1
+            upper[bump + 1:] = [0] * (2 - bump)
+            comparisons.append(('>=', low))
+            comparisons.append(('<', semver_key(*upper, '')))
+        else:
+            comparisons.append((op, low))
+    return comparisons
+
+
+def _version_matches(key, comparisons):
+    for op, bound in comparisons:
+        if not ((op == '==' and key == bound) or (op == '!=' and key != bound) or (op == '>=' and key >= bound)
+                or (op == '>' and key > bound) or (op == '<=' and key <= bound) or (op == '<' and key < bound)):
+            return False
+    return True
+
+
+def version_satisfies(version, constraint):
+    """True when version meets constraint by the rules of resolve_package_version.
+
+    Raises ValueError for a malformed constraint.
+    """
+    version = (version or '').strip()
+    constraint = (constraint or '').strip()
+    if version == constraint:
+        return True
+    comparisons = parse_version_constraint(constraint)
+    parsed = parse_semver(version)
+    if parsed is None or (parsed[3] and all(bound[3] == (1,) for _, bound in comparisons)):
+        return False
+    return _version_matches(semver_key(*parsed[:4]), comparisons)
+
+
+def _record_package_versions(c, rows):
+    """Index (name, version, username, filename, sha256, size, created_at) rows; an existing version is kept."""
+    values = []
+    for name, version, username, filename, sha256, size, created_at in rows:
+        version = (version or '').strip()
+        if not version or not sha256:
+            continue
+        parsed = parse_semver(version)
+        major, minor, patch, pre = parsed[:4] if parsed else (None, None, None, '')
+        values.append((name, normalize_package_name(name), version, major, minor, patch, pre,
+                       username, filename, sha256, size, created_at))
+    c.executemany('INSERT OR IGNORE INTO package_versions (name, name_key, version, major, minor, patch, prerelease, '
+                  'username, filename, sha256, size, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', values)
+
+
+def get_package_versions(name):
+    """All published versions of a package, newest first by semver precedence."""
+    c = get_db().cursor()
+    c.execute(f'SELECT {", ".join(VERSION_FIELDS)}, major, minor, patch FROM package_versions '
+              'WHERE name_key = ? ORDER BY major DESC, minor DESC, patch DESC', (normalize_package_name(name),))
+    versions = []
+    for row in c.fetchall():
+        version = dict(zip(VERSION_FIELDS, row))
+        version['semver'] = semver_key(*row[-3:], version['prerelease']) if row[-3] is not None else None
+        versions.append(version)
+    # unparseable versions sort last, by publish time
+    versions.sort(key=lambda v: (v['semver'] is not None, v['semver'] or (), v['created_at']), reverse=True)
+    return versions
+
+
+def resolve_package_version(name, constraint):
+    """Highest published version of name satisfying constraint, or None.
+
+    Pre-releases only match when the constraint names one. Raises ValueError for a
+    malformed constraint.
+    """
+    versions = get_package_versions(name)
+    constraint = (constraint or '').strip()
+    for version in versions:
+        if version['version'] == constraint:
+            return version
+    comparisons = parse_version_constraint(constraint)
+    allow_prerelease = any(bound[3] != (1,) for _, bound in comparisons)
+    for version in versions:
+        if version['semver'] is None or (version['prerelease'] and not allow_prerelease):
+            continue
+        if _version_matches(version['semver'], comparisons):
+            return version
+    return None
 
 
-def register_package(username, filename):
-    """Register a package in the database when uploaded/approved."""
-    filepath = os.path.join(PUBLIC_DIR, username, filename)
-    try:
-        stats = os.stat(filepath)
-        size = stats.st_size
-        created_at = int(stats.st_mtime)
-    except OSError:
-        size = 0
-        created_at = int(time.time())
-    
+def version_conflict(name, version, sha256):
+    """The already-published row if name@version exists with different content, else None."""
+    version = (version or '').strip()
+    if not version:
+        return None
+    c = get_db().cursor()
+    c.execute('SELECT username, filename, sha256 FROM package_versions WHERE name_key = ? AND version = ?',
+              (normalize_package_name(name), version))
+    row = c.fetchone()
+    if row and row[2] != sha256:
+        return {'username': row[0], 'filename': row[1], 'sha256': row[2]}
+    return None
+
+
+def publish_conflict(path, username, filename, digest=None):
+    """Message if path can't be published as username/filename: the name belongs to another
+    package, or the version is already published with different content."""
+    return package_name_conflict(username, filename) or _version_conflict_message(path, filename, digest)
+
+
+def _version_conflict_message(path, filename, digest=None):
     name = filename.rsplit('.', 1)[0]
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('INSERT OR REPLACE INTO packages (name, filename, username, size, created_at) VALUES (?, ?, ?, ?, ?)',
-              (name, filename, username, size, created_at))
-    conn.commit()
-    conn.close()
+    version = parse_leaf_manifest(path)['version']
+    if version_conflict(name, version, digest or file_sha256(path)):
+        return f'{name} {version.strip()} is already published; bump the version to publish new content'
+    return None
 
 
-def unregister_package(username, filename):
-    """Remove a package from the database when deleted."""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('DELETE FROM packages WHERE username = ? AND filename = ?', (username, filename))
-    conn.commit()
-    conn.close()
+def version_payload(version):
+    """JSON shape for one immutable version; its bytes are served from the blob URL."""
+    return {
+        'name': version['name'],
+        'version': version['version'],
+        'username': version['username'],
+        'filename': version['filename'],
+        'size': version['size'],
+        'created_at': version['created_at'],
+        'prerelease': bool(version['prerelease']),
+        'sha256': version['sha256'],
+        'blob_url': f"/blobs/{version['sha256']}",
+        'download_url': f"/blobs/{version['sha256']}",
+    }
 
 
-def get_package_by_name(name):
-    """Find a package by name (case-insensitive)."""
-    conn = sqlite3.connect(DB_PATH)
+def get_package_dependencies(package_id):
+    """Dependency entries of a package, in manifest order, from the stored metadata."""
+    c = get_db().cursor()
+    c.execute('SELECT dependency FROM package_dependencies WHERE package_id = ? ORDER BY position', (package_id,))
+    return [r[0] for r in c.fetchall()]
+
+
+def get_package_dependents(name):
+    """Packages that list name as a direct dependency (served by the dependency_name index)."""
+    c = get_db().cursor()
+    c.execute('SELECT DISTINCT p.name, p.filename, p.username FROM package_dependencies d '
+              'JOIN packages p ON p.id = d.package_id WHERE d.dependency_name = ? '
+              'ORDER BY p.name COLLATE NOCASE, p.id', (dependency_name(name),))
+    return [{'name': r[0], 'filename': r[1], 'username': r[2]} for r in c.fetchall()]
+
+
+def reverse_dependency_closure(name):
+    """Every package that depends on name directly or transitively.
+
+    Returns (dependents, cycles); dependents are ordered nearest-first by DFS.
+    """
+    root = dependency_name(name)
+    dependents = []
+    cycles = []
+    state = {root: 'visiting'}
+    path = [(root, iter(get_package_dependents(root)))]
+    while path:
+        key, users = path[-1]
+        pkg = next(users, None)
+        if pkg is None:
+            path.pop()
+            state[key] = 'done'
+            continue
+        pkg_key = dependency_name(pkg['name'])
+        pkg_state = state.get(pkg_key)
+        if pkg_state == 'visiting':
+            start = next(i for i, entry in enumerate(path) if entry[0] == pkg_key)
+            cycles.append([entry[0] for entry in path[start:]] + [pkg_key])
+        elif pkg_state is None:
+            state[pkg_key] = 'visiting'
+            dependents.append(pkg)
+            path.append((pkg_key, iter(get_package_dependents(pkg_key))))
+    return dependents, cycles
+
+
+# sort key -> ORDER BY column; id breaks ties so pages are stable
+PACKAGE_SORT_COLUMNS = {
+    'name': 'name COLLATE NOCASE',
+    'date': 'created_at',
+    'size': 'size',
+}
+PACKAGES_PER_PAGE = 50
+
+
+def list_packages(sort_by='name', order='asc', limit=PACKAGES_PER_PAGE, offset=0):
+    """Return one page of packages ordered by an indexed column."""
+    column = PACKAGE_SORT_COLUMNS.get(sort_by, PACKAGE_SORT_COLUMNS['name'])
+    direction = 'DESC' if order == 'desc' else 'ASC'
+    conn = get_db()
     c = conn.cursor()
-    c.execute('SELECT name, filename, username, size, created_at FROM packages WHERE LOWER(name) = LOWER(?)', (name,))
-    row = c.fetchone()
-    conn.close()
-    if not row:
+    c.execute(f'SELECT name, filename, username, size, created_at, version, description FROM packages '
+              f'ORDER BY {column} {direction}, id {direction} LIMIT ? OFFSET ?',
+              (limit, offset))
+    return [{'name': r[0], 'filename': r[1], 'username': r[2], 'size': r[3], 'created_at': r[4],
+             'version': r[5] or '', 'description': r[6] or ''}
+            for r in c.fetchall()]
+
+
+# column order of the rows in /api/index responses
+INDEX_FIELDS = ('name', 'username', 'filename', 'size', 'created_at', 'sha256', 'version')
+_index_snapshot = (None, None)  # (generation, serialized body) of the last full snapshot
+
+
+@contextlib.contextmanager
+def read_snapshot():
+    """Run the enclosed reads in one transaction, so they all see the same database state."""
+    conn = get_db()
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute('BEGIN')
+    try:
+        yield conn
+    finally:
+        conn.commit()
+
+
+def package_index_generation():
+    """Current publish generation; changes whenever a package is added or removed."""
+    c = get_db().cursor()
+    c.execute('SELECT COALESCE(MAX(generation), 0) FROM package_changes')
+    return c.fetchone()[0]
+
+
+def package_index_snapshot():
+    """Every published package as compact rows in INDEX_FIELDS order."""
+    c = get_db().cursor()
+    c.execute('SELECT name, username, filename, size, created_at, sha256, version FROM packages ORDER BY id')
+    return [list(r) for r in c.fetchall()]
+
+
+def package_index_document(since=None):
+    """(etag, render) for /api/index: the full catalog, or a delta when since is still covered.
+
+    render() builds the JSON body; callers skip it when the client's ETag matches.
+    The generation and the rows it describes are read in one transaction, so a publish
+    committed in between can't pair an ETag with rows from a different state.
+    """
+    with read_snapshot():
+        generation = package_index_generation()
+        delta = package_index_delta(since) if since is not None and since >= 0 else None
+    if delta is not None:
+        added, removed = delta
+        return f'idx-{generation}-since-{since}', lambda: app.json.dumps(
+            {'generation': generation, 'since': since, 'fields': INDEX_FIELDS, 'added': added, 'removed': removed})
+
+    def render():
+        global _index_snapshot
+        cached_generation, body = _index_snapshot
+        if cached_generation != generation:
+            # read again with the rows: a publish since the ETag was taken only makes the body
+            # newer than its ETag, and the client then simply gets it again next time
+            with read_snapshot():
+                current = package_index_generation()
+                packages = package_index_snapshot()
+            body = app.json.dumps({'generation': current, 'fields': INDEX_FIELDS, 'packages': packages})
+            _index_snapshot = (current, body)
+        return body
+    return f'idx-{generation}', render
+
+
+def package_index_delta(since):
+    """Packages added/replaced and removed after generation since.
+
+    Returns (added_rows, removed_pairs), or None when the change log no longer
+    reaches back that far and the caller should fall back to a full snapshot.
+    """
+    c = get_db().cursor()
+    c.execute('SELECT MIN(generation) FROM package_changes')
+    oldest = c.fetchone()[0]
+    if oldest is not None and since < oldest - 1:
         return None
-    return {
-        'name': row[0],
-        'filename': row[1],
-        'username': row[2],
-        'size': row[3],
-        'created_at': row[4]
-    }
+    c.execute('SELECT DISTINCT username, filename FROM package_changes WHERE generation > ?', (since,))
+    touched = c.fetchall()
+    added = []
+    removed = []
+    for username, filename in touched:
+        c.execute('SELECT name, username, filename, size, created_at, sha256, version FROM packages WHERE username = ? AND filename = ?',
+                  (username, filename))
+        row = c.fetchone()
+        if row:
+            added.append(list(row))
+        else:
+            removed.append([username, filename])
+    return added, removed
 
 
 def get_user_by_username(username):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
-    c.execute('SELECT id, username, password_hash, bio, username_changed_at, uuid, role, ban_until FROM users WHERE username = ?', (username,))
+    c.execute('SELECT id, username, password_hash, bio, username_changed_at, uuid, role, ban_until, avatar_ext, avatar_version FROM users WHERE username = ?', (username,))
     row = c.fetchone()
-    conn.close()
     if not row:
         return None
     return {
@@ -229,17 +2061,18 @@ def get_user_by_username(username):
         'username_changed_at': int(row[4] or 0),
         'uuid': row[5] or '',
         'role': (row[6] or 'member').lower(),
-        'ban_until': int(row[7] or 0)
+        'ban_until': int(row[7] or 0),
+        'avatar_ext': row[8] or '',
+        'avatar_version': int(row[9] or 0)
     }
 
 def get_user_by_uuid(user_uuid):
     if not user_uuid:
         return None
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
-    c.execute('SELECT id, username, password_hash, bio, username_changed_at, uuid, role, ban_until FROM users WHERE uuid = ?', (user_uuid,))
+    c.execute('SELECT id, username, password_hash, bio, username_changed_at, uuid, role, ban_until, avatar_ext, avatar_version FROM users WHERE uuid = ?', (user_uuid,))
     row = c.fetchone()
-    conn.close()
     if not row:
         return None
     return {
@@ -250,9 +2083,18 @@ def get_user_by_uuid(user_uuid):
         'username_changed_at': int(row[4] or 0),
         'uuid': row[5] or '',
         'role': (row[6] or 'member').lower(),
-        'ban_until': int(row[7] or 0)
+        'ban_until': int(row[7] or 0),
+        'avatar_ext': row[8] or '',
+        'avatar_version': int(row[9] or 0)
     }
 
+def avatar_url(username, avatar_ext, avatar_version):
+    """URL of a user's avatar from its stored extension/version; no filesystem access."""
+    if not avatar_ext:
+        return url_for('static', filename='images/defaultprofilepicture.jpg')
+    return url_for('static', filename=f'images/profiles/{username}{avatar_ext}', v=avatar_version)
+
+
 def is_user_banned(user):
     """Check if user is currently banned. Returns (is_banned, ban_until_timestamp)."""
     if not user:
@@ -266,7 +2108,7 @@ def is_user_banned(user):
 
 def ban_user(username, duration_seconds):
     """Ban a user for duration_seconds. Use -1 for permanent ban, 0 to unban."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     if duration_seconds == 0:
         ban_until = 0
@@ -276,101 +2118,279 @@ def ban_user(username, duration_seconds):
         ban_until = int(time.time() + duration_seconds)
     c.execute('UPDATE users SET ban_until = ? WHERE username = ?', (ban_until, username))
     conn.commit()
-    conn.close()
+    session_user_cache.invalidate(username=username)
 
 
 def create_post(author, title, content):
     """Create a new announcement post."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     created_at = int(time.time())
     c.execute('INSERT INTO posts (author, title, content, created_at) VALUES (?, ?, ?, ?)',
               (author, title, content, created_at))
     conn.commit()
     post_id = c.lastrowid
-    conn.close()
+    page_cache.invalidate()
     return post_id
 
 
 def get_posts(limit=10):
     """Get recent posts, newest first."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT id, author, title, content, created_at FROM posts ORDER BY created_at DESC LIMIT ?', (limit,))
     rows = c.fetchall()
-    conn.close()
     return [{'id': r[0], 'author': r[1], 'title': r[2], 'content': r[3], 'created_at': r[4]} for r in rows]
 
 
 def delete_post(post_id):
     """Delete a post by ID."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('DELETE FROM posts WHERE id = ?', (post_id,))
     conn.commit()
-    conn.close()
+    page_cache.invalidate()
+
+
+# --- password hashing ----------------------------------------------------------------------------------
+# Hashes are deliberately slow, so they run in a small process pool instead of on the request
+# thread. Callers beyond workers + queue wait up to PASSWORD_HASH_WAIT and then get PasswordHasherBusy.
+PASSWORD_HASH_METHOD = os.environ.get('LEAF_PASSWORD_METHOD', 'scrypt')  # e.g. scrypt:65536:8:1, pbkdf2:sha256:1000000
+PASSWORD_HASH_WORKERS = int(os.environ.get('LEAF_PASSWORD_WORKERS', str(min(4, os.cpu_count() or 1))))  # 0: hash inline
+PASSWORD_HASH_QUEUE = int(os.environ.get('LEAF_PASSWORD_QUEUE', '32'))
+PASSWORD_HASH_WAIT = float(os.environ.get('LEAF_PASSWORD_WAIT', '5'))
+
+
+class PasswordHasherBusy(Exception):
+    """Every hashing slot stayed taken for PASSWORD_HASH_WAIT seconds."""
+
+
+def canonical_hash_method(method):
+    """Spell out werkzeug's defaults (scrypt -> scrypt:32768:8:1) so methods compare against stored hashes."""
+    parts = method.split(':')
+    if parts[0] == 'scrypt':
+        defaults = ['scrypt', '32768', '8', '1']
+    elif parts[0] == 'pbkdf2':
+        defaults = ['pbkdf2', 'sha256', str(DEFAULT_PBKDF2_ITERATIONS)]
+    else:
+        return method
+    return ':'.join(parts + defaults[len(parts):])
+
+
+class PasswordHasher:
+    """Bounded pool for generate/check_password_hash with backpressure and counters."""
+
+    def __init__(self, method, workers, queue, wait):
+        self.method = canonical_hash_method(method)
+        self.workers = workers
+        self.queue = queue
+        self.wait = wait
+        self._slots = threading.BoundedSemaphore(max(workers, 1) + queue)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+        self._stats = {'hashes': 0, 'verifies': 0, 'rehashes': 0, 'rejected': 0, 'in_flight': 0, 'seconds': 0.0}
+
+    def _executor(self, broken=None):
+        # one pool per process; spawn keeps the workers clear of locks held by this process's threads.
+        # Pass the pool that raised BrokenProcessPool to have it replaced (once, however many saw it).
+        with self._lock:
+            if self._pool_pid != os.getpid() or (broken is not None and self._pool is broken):
+                if broken is not None:
+                    logging.warning('password hash pool broke; starting a new one')
+                    broken.shutdown(wait=False)
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _submit(self, fn, *args):
+        pool = self._executor()
+        try:
+            return pool.submit(fn, *args).result()
+        except BrokenProcessPool:
+            # a worker died (e.g. OOM-killed); the pool is unusable from now on
+            return self._executor(broken=pool).submit(fn, *args).result()
+
+    def _run(self, counter, fn, *args):
+        if not self._slots.acquire(timeout=self.wait):
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise PasswordHasherBusy()
+        with self._lock:
+            self._stats['in_flight'] += 1
+        started = time.perf_counter()
+        try:
+            if self.workers <= 0:
+                return fn(*args)
+            return self._submit(fn, *args)
+        finally:
+            self._slots.release()
+            with self._lock:
+                self._stats['in_flight'] -= 1
+                self._stats[counter] += 1
+                self._stats['seconds'] += time.perf_counter() - started
+
+    def hash(self, password):
+        return self._run('hashes', generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run('verifies', check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        return password_hash.split('$', 1)[0] != self.method
+
+    def note_rehash(self):
+        with self._lock:
+            self._stats['rehashes'] += 1
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._stats)
+        out.update(method=self.method, workers=self.workers, queue_limit=self.queue,
+                   queued=max(0, out['in_flight'] - max(self.workers, 1)))
+        done = out['hashes'] + out['verifies']
+        out['avg_ms'] = round(out['seconds'] * 1000 / done, 2) if done else 0.0
+        return out
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_METHOD, PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE, PASSWORD_HASH_WAIT)
+
+
+def verify_user_password(user, password):
+    """Check password against user's hash, upgrading the hash if PASSWORD_HASH_METHOD changed."""
+    if not password_hasher.verify(user['password_hash'], password):
+        return False
+    if password_hasher.needs_rehash(user['password_hash']):
+        try:
+            new_hash = password_hasher.hash(password)
+        except PasswordHasherBusy:
+            return True  # upgrade on a later login
+        conn = get_db()
+        conn.execute('UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?',
+                     (new_hash, user['id'], user['password_hash']))
+        conn.commit()
+        password_hasher.note_rehash()
+    return True
 
 
 def create_user(username, password):
+    # hashed outside the try: PasswordHasherBusy is the caller's to report, not "username taken"
+    ph = password_hasher.hash(password)
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         c = conn.cursor()
-        ph = generate_password_hash(password)
         user_uuid = str(uuid.uuid4())
         role = 'owner' if username.lower() == 'frogman' else 'member'
         c.execute('INSERT INTO users (username, password_hash, bio, username_changed_at, uuid, role) VALUES (?, ?, ?, ?, ?, ?)', (username, ph, '', 0, user_uuid, role))
+        _index_user_search(c, c.lastrowid, username)
         conn.commit()
-        conn.close()
         return True
     except Exception:
         return False
 
+USER_FTS = True
+# trigrams need at least three characters; shorter queries only use the prefix index
+USER_FTS_MIN_QUERY = 3
+
+
+def _index_user_search(c, user_id, username):
+    if not USER_FTS:
+        return
+    c.execute('DELETE FROM users_fts WHERE rowid = ?', (user_id,))
+    c.execute('INSERT INTO users_fts (rowid, username) VALUES (?, ?)', (user_id, username))
+
+
 def search_users(query, limit=20):
-    """Search users by username prefix/substring. Returns list of user dicts."""
+    """Search users by username. Exact matches rank first, then prefix, then substring matches."""
     if not query or not query.strip():
         return []
     q = query.strip()
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
-    # Case-insensitive LIKE search
-    c.execute(
-        'SELECT id, username, bio, role FROM users WHERE username LIKE ? LIMIT ?',
-        (f'%{q}%', limit)
-    )
-    rows = c.fetchall()
-    conn.close()
+    columns = 'SELECT users.id, users.username, users.bio, users.role, users.avatar_ext, users.avatar_version FROM users'
+    rows = []
+    # exact and prefix matches both come straight off idx_users_username_nocase
+    c.execute(f'{columns} WHERE username = ? COLLATE NOCASE LIMIT 1', (q,))
+    rows.extend(c.fetchall())
+    escaped = q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    c.execute(f"{columns} WHERE username LIKE ? ESCAPE '\\' ORDER BY username COLLATE NOCASE LIMIT ?",
+              (escaped + '%', limit))
+    prefix_rows = c.fetchall()
+    rows.extend(prefix_rows)
+    # only pay for a substring search when prefixes didn't fill the page
+    if len(prefix_rows) < limit:
+        if USER_FTS and len(q) >= USER_FTS_MIN_QUERY:
+            c.execute(f'{columns} JOIN users_fts ON users_fts.rowid = users.id '
+                      'WHERE users_fts MATCH ? ORDER BY rank LIMIT ?',
+                      ('"' + q.replace('"', '""') + '"', limit + 1))
+            rows.extend(c.fetchall())
+        elif not USER_FTS:
+            c.execute(f"{columns} WHERE username LIKE ? ESCAPE '\\' LIMIT ?", ('%' + escaped + '%', limit + 1))
+            rows.extend(c.fetchall())
     results = []
+    seen = set()
     for row in rows:
+        if row[0] in seen:
+            continue
+        seen.add(row[0])
         results.append({
             'id': row[0],
             'username': row[1],
             'bio': row[2] or '',
-            'role': (row[3] or 'member').lower()
+            'role': (row[3] or 'member').lower(),
+            'avatar_ext': row[4] or '',
+            'avatar_version': int(row[5] or 0)
         })
+        if len(results) >= limit:
+            break
     return results
 
+def _search_matches(c, match):
+    """Packages matching an FTS expression, counted up to PACKAGE_SEARCH_RANK_LIMIT + 1."""
+    c.execute('SELECT COUNT(*) FROM (SELECT rowid FROM packages_fts WHERE packages_fts MATCH ? LIMIT ?)',
+              (match, PACKAGE_SEARCH_RANK_LIMIT + 1))
+    return c.fetchone()[0]
+
+
 def search_packages(query, limit=20):
-    """Search packages by filename in public directory. Returns list of package dicts."""
+    """Search packages by name, author, description and dependencies. Returns ranked package dicts."""
     if not query or not query.strip():
         return []
-    q = query.strip().lower()
-    results = []
-    if not os.path.isdir(PUBLIC_DIR):
-        return results
-    for username in os.listdir(PUBLIC_DIR):
-        user_dir = os.path.join(PUBLIC_DIR, username)
-        if not os.path.isdir(user_dir):
-            continue
-        for fn in os.listdir(user_dir):
-            if allowed_file(fn) and q in fn.lower():
-                results.append({
-                    'filename': fn,
-                    'username': username,
-                    'name': fn.rsplit('.', 1)[0]  # name without extension
-                })
-                if len(results) >= limit:
-                    return results
-    return results
+    # every word must match, the last one as a prefix (it may still be being typed);
+    # quoting keeps FTS syntax out of user input
+    terms = re.findall(r'\w+', query.lower())
+    if not terms:
+        return []
+    conn = get_db()
+    c = conn.cursor()
+    if PACKAGE_FTS:
+        exact = ' '.join(f'"{t}"' for t in terms)
+        columns = ('SELECT p.id, p.name, p.filename, p.username, p.description, p.version FROM packages_fts '
+                   'JOIN packages p ON p.id = packages_fts.rowid WHERE packages_fts MATCH ?')
+        # prefix matching is the slow part, so a query whose exact words are already common
+        # skips it; otherwise the prefix form decides between ranking and the fast path
+        match = exact if _search_matches(c, exact) > PACKAGE_SEARCH_RANK_LIMIT else exact + '*'
+        if match != exact and _search_matches(c, match) <= PACKAGE_SEARCH_RANK_LIMIT:
+            weights = ', '.join(str(w) for w in PACKAGE_FTS_WEIGHTS)
+            c.execute(f'{columns} ORDER BY bm25(packages_fts, {weights}) LIMIT ?', (match, limit))
+            rows = c.fetchall()
+        else:
+            rows = []
+            for expr in (f'name : ({match})', match):
+                c.execute(f'{columns} ORDER BY packages_fts.rowid DESC LIMIT ?', (expr, limit))
+                seen = {r[0] for r in rows}
+                rows.extend(r for r in c.fetchall() if r[0] not in seen)
+                if len(rows) >= limit:
+                    break
+        return [{'name': r[1], 'filename': r[2], 'username': r[3], 'description': r[4] or '', 'version': r[5] or ''}
+                for r in rows[:limit]]
+    else:
+        c.execute(
+            "SELECT name, filename, username, description, version FROM packages WHERE name LIKE ? ORDER BY name COLLATE NOCASE LIMIT ?",
+            (f'%{query.strip()}%', limit)
+        )
+    return [{'name': r[0], 'filename': r[1], 'username': r[2], 'description': r[3] or '', 'version': r[4] or ''}
+            for r in c.fetchall()]
 
 
 def parse_leaf_manifest(filepath):
@@ -441,59 +2461,279 @@ def parse_leaf_manifest(filepath):
         pass
     return manifest
 
-init_db()
+def _parse_manifest_timed(filepath):
+    started = time.perf_counter()
+    manifest = parse_leaf_manifest(filepath)
+    sample = getattr(_request_sample, 'current', None)
+    if sample is not None:
+        sample['manifest_seconds'] += time.perf_counter() - started
+    return manifest
+
+
+class ManifestCache:
+    """Bounded LRU of parsed manifests keyed on (path, mtime, size).
+
+    Entries are evicted least-recently-used first once either the entry count or
+    the total size of the cached raw manifests exceeds its limit. Cached dicts are
+    shared between requests and must be treated as read-only.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # path -> (mtime_ns, size, manifest)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, filepath, st=None):
+        """Return the parsed manifest for filepath, parsing only if the file changed."""
+        if st is None:
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                return _parse_manifest_timed(filepath)
+        with self._lock:
+            entry = self._entries.get(filepath)
+            if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                self._entries.move_to_end(filepath)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        manifest = _parse_manifest_timed(filepath)
+        weight = len(manifest['raw'])
+        if weight > self.max_bytes:
+            return manifest
+        with self._lock:
+            self._drop(filepath)
+            self._entries[filepath] = (st.st_mtime_ns, st.st_size, manifest)
+            self._bytes += weight
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, _, old) = self._entries.popitem(last=False)
+                self._bytes -= len(old['raw'])
+                self.evictions += 1
+        return manifest
+
+    def _drop(self, filepath):
+        entry = self._entries.pop(filepath, None)
+        if entry:
+            self._bytes -= len(entry[2]['raw'])
+
+    def invalidate(self, filepath):
+        with self._lock:
+            self._drop(filepath)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+manifest_cache = ManifestCache(
+    int(os.environ.get('LEAF_MANIFEST_CACHE_ENTRIES', '512')),
+    int(os.environ.get('LEAF_MANIFEST_CACHE_BYTES', str(8 * 1024 * 1024))),
+)
+
+class SessionUserCache:
+    """Short-lived per-process cache of the user fields sync_session_from_db needs, keyed by uuid.
+
+    Writers in this process call invalidate(). Any other change to those fields, from
+    another worker or made directly in the database, bumps the users generation (see
+    the triggers in init_db); check_generation() reads it at most every check_interval
+    seconds and empties the cache when it moved.
+    """
+
+    def __init__(self, ttl, max_entries, check_interval):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.check_interval = check_interval
+        self._entries = {}  # uuid -> (expires_at, user fields)
+        self._lock = threading.Lock()
+        self._generation = None
+        self._checked_at = float('-inf')
+        self.hits = 0
+        self.misses = 0
+
+    def check_generation(self, read_generation):
+        """Call read_generation() if check_interval has passed; drop every entry if it moved."""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+        generation = read_generation()
+        with self._lock:
+            if generation != self._generation:
+                self._entries.clear()
+                self._generation = generation
+
+    def get(self, user_uuid):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_uuid)
+            if entry and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        return None
+
+    def put(self, user):
+        fields = {k: user.get(k) for k in ('uuid', 'username', 'role', 'ban_until', 'avatar_ext', 'avatar_version')}
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                now = time.monotonic()
+                self._entries = {k: v for k, v in self._entries.items() if v[0] > now}
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+            self._entries[fields['uuid']] = (time.monotonic() + self.ttl, fields)
+
+    def invalidate(self, user_uuid=None, username=None):
+        with self._lock:
+            if user_uuid:
+                self._entries.pop(user_uuid, None)
+            if username:
+                for key in [k for k, (_, u) in self._entries.items() if u['username'] == username]:
+                    del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses}
+
+
+def users_generation():
+    c = get_db().cursor()
+    c.execute("SELECT generation FROM cache_generations WHERE name = 'users'")
+    row = c.fetchone()
+    return row[0] if row else 0
+
+
+session_user_cache = SessionUserCache(
+    float(os.environ.get('LEAF_SESSION_CACHE_TTL', '30')),
+    int(os.environ.get('LEAF_SESSION_CACHE_ENTRIES', '4096')),
+    float(os.environ.get('LEAF_SESSION_CACHE_CHECK', '1')),  # seconds between users generation reads
+)
+
+class PageCache:
+    """Rendered HTML (whole pages or fragments) by key, per process.
+
+    Writers of the underlying data call invalidate(); other processes pick the change up
+    once the TTL expires.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}  # key -> (expires_at, html)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, key, render):
+        """Return the cached HTML for key, calling render() to produce it on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+        html = render()
+        with self._lock:
+            # an invalidate() during render means html may already be stale
+            if generation == self._generation:
+                self._entries[key] = (now + self.ttl, html)
+        return html
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses}
+
+
+page_cache = PageCache(float(os.environ.get('LEAF_PAGE_CACHE_TTL', '10')))
+
+# spawned password-hash workers import `python web/server.py` again as __mp_main__;
+# they only need werkzeug, not the migrations and package sync
+if __name__ != '__mp_main__':
+    init_db()
 # -----------------------------------------------------------------------------------------------------
 
 @app.before_request
 def sync_session_from_db():
-    # keep session role/uuid in sync with DB so promotions take effect immediately
+    # keep session role/uuid in sync with DB; the short-lived cache keeps the user lookup off the database on most requests
     suuid = session.get('uuid')
     u = None
     if suuid:
-        u = get_user_by_uuid(suuid)
+        # changes from other workers reach this one within LEAF_SESSION_CACHE_CHECK seconds
+        session_user_cache.check_generation(users_generation)
+        u = session_user_cache.get(suuid)
+        if u is None:
+            u = get_user_by_uuid(suuid)
+            if u:
+                session_user_cache.put(u)
     else:
         uname = session.get('user')
         if uname:
             u = get_user_by_username(uname)
+    g.current_user = u
     if u:
-        # Always reflect latest DB state in session
-        session['role'] = u.get('role', 'member')
-        session['user'] = u.get('username')
+        # Always reflect latest DB state in session; only write changed keys so unchanged
+        # sessions aren't re-sent as Set-Cookie (which would make responses uncacheable)
+        latest = {'role': u.get('role', 'member'), 'user': u.get('username')}
         if u.get('uuid'):
-            session['uuid'] = u.get('uuid')
+            latest['uuid'] = u.get('uuid')
+        for key, value in latest.items():
+            if session.get(key) != value:
+                session[key] = value
 
 
 @app.context_processor
 def inject_nav_context():
     # Provide current user's avatar URL to templates
-    avatar_url = None
-    uname = session.get('user')
-    if uname:
-        # default avatar
-        profile_url = url_for('static', filename='images/defaultprofilepicture.jpg')
-        profiles_dir = os.path.join(BASE_DIR, 'static', 'images', 'profiles')
-        for ext in AVATAR_EXTS:
-            candidate = os.path.join(profiles_dir, f"{uname}{ext}")
-            if os.path.isfile(candidate):
-                try:
-                    mtime = int(os.path.getmtime(candidate))
-                except Exception:
-                    mtime = 0
-                profile_url = url_for('static', filename=f'images/profiles/{uname}{ext}', v=mtime)
-                break
-        avatar_url = profile_url
-    return {'current_avatar_url': avatar_url}
+    avatar = None
+    u = g.get('current_user')
+    if u and session.get('user'):
+        avatar = avatar_url(u['username'], u.get('avatar_ext'), u.get('avatar_version'))
+    return {'current_avatar_url': avatar}
+
+def announcements_fragment():
+    """The rendered announcements section; admins get a variant with post controls."""
+    can_post = (session.get('role') or 'member').lower() in ('admin', 'owner')
+    return Markup(page_cache.render(
+        ('announcements', can_post, request.script_root),
+        lambda: render_template('_announcements.html', posts=get_posts(limit=5))))
+
+
+def render_index():
+    # anonymous visitors all see the same page; signed-in ones get their own nav around the cached fragment
+    if not session.get('user'):
+        return page_cache.render(('index', request.script_root),
+                                 lambda: render_template('index.html', announcements=announcements_fragment()))
+    return render_template('index.html', announcements=announcements_fragment())
+
 
 @app.route('/', methods=['GET'])
 def index():
-    posts = get_posts(limit=5)
-    return render_template('index.html', posts=posts)
+    return render_index()
 
 
 @app.route('/home')
 def home_redirect():
-    posts = get_posts(limit=5)
-    return render_template('index.html', posts=posts)
+    return render_index()
 
 
 @app.route('/post/create', methods=['POST'])
@@ -540,22 +2780,110 @@ def search():
         users = search_users(q)
         packages = search_packages(q)
         # resolve avatar URLs for each user result
-        profiles_dir = os.path.join(BASE_DIR, 'static', 'images', 'profiles')
         for u in users:
-            avatar_url = url_for('static', filename='images/defaultprofilepicture.jpg')
-            for ext in AVATAR_EXTS:
-                candidate = os.path.join(profiles_dir, f"{u['username']}{ext}")
-                if os.path.isfile(candidate):
-                    try:
-                        mtime = int(os.path.getmtime(candidate))
-                    except Exception:
-                        mtime = 0
-                    avatar_url = url_for('static', filename=f"images/profiles/{u['username']}{ext}", v=mtime)
-                    break
-            u['avatar_url'] = avatar_url
+            u['avatar_url'] = avatar_url(u['username'], u['avatar_ext'], u['avatar_version'])
     return render_template('search.html', query=q, users=users, packages=packages)
 
 
+def package_payload(pkg):
+    """JSON shape shared by the package API endpoints."""
+    payload = {
+        'name': pkg['name'],
+        'filename': pkg['filename'],
+        'username': pkg['username'],
+        'size': pkg['size'],
+        'version': pkg.get('version') or '',
+        'description': pkg.get('description') or '',
+        'download_url': f"/userfiles/{pkg['username']}/{pkg['filename']}"
+    }
+    if pkg.get('sha256'):
+        payload['sha256'] = pkg['sha256']
+        payload['blob_url'] = f"/blobs/{pkg['sha256']}"
+    return payload
+
+
+def resolve_dependencies(names):
+    """Resolve the transitive dependency closure of names.
+
+    Returns (packages, missing, cycles): packages in install order (dependencies
+    before dependents), requirements nothing published satisfies, and dependency cycles
+    found. Names and dependency entries may carry a constraint ("foo >= 2", "foo@^1.4").
+    The first requirement reached picks the highest matching version of a package;
+    later requirements of the same package are checked against that pick.
+    """
+    order = []
+    missing = []
+    cycles = []
+    state = {}  # normalized name -> 'visiting' | 'done' | 'missing'
+    picked = {}  # normalized name -> version string chosen for it
+
+    def unsatisfied(name, required_by, constraint, resolved=None):
+        entry = {'name': name, 'required_by': required_by}
+        if constraint:
+            entry['constraint'] = constraint
+        if resolved is not None:
+            entry['resolved'] = resolved
+        missing.append(entry)
+
+    def enter(name, constraint, required_by, path):
+        key = normalize_package_name(name)
+        pkg = get_package_by_name(name)
+        if not pkg:
+            state[key] = 'missing'
+            unsatisfied(name, required_by, constraint)
+            return
+        try:
+            latest_ok = not constraint or version_satisfies(pkg.get('version'), constraint)
+            version = None if latest_ok else resolve_package_version(name, constraint)
+        except ValueError:
+            latest_ok, version = False, None
+        if latest_ok:
+            pkg = dict(package_payload(pkg), dependencies=get_package_dependencies(pkg['id']))
+        elif version:
+            # an older release: its dependencies come from its own manifest
+            manifest = manifest_cache.get(blob_path(version['sha256']))
+            pkg = dict(version_payload(version), dependencies=manifest['dependencies'])
+        else:
+            unsatisfied(name, required_by, constraint)
+            return
+        state[key] = 'visiting'
+        picked[key] = pkg['version']
+        path.append((key, pkg, iter(pkg['dependencies'])))
+
+    def require(entry, required_by, path):
+        name, constraint = split_dependency(entry)
+        key = normalize_package_name(name)
+        key_state = state.get(key)
+        if key_state is None:
+            enter(name, constraint, required_by, path)
+            return
+        if key_state == 'visiting':
+            start = next(i for i, item in enumerate(path) if item[0] == key)
+            cycles.append([item[1]['name'] for item in path[start:]] + [path[start][1]['name']])
+        if key_state != 'missing' and constraint:
+            try:
+                ok = version_satisfies(picked[key], constraint)
+            except ValueError:
+                ok = False
+            if not ok:
+                unsatisfied(name, required_by, constraint, picked[key])
+
+    # iterative DFS so long dependency chains can't hit the recursion limit
+    for root in names:
+        path = []
+        require(root, None, path)
+        while path:
+            key, pkg, deps = path[-1]
+            dep = next(deps, None)
+            if dep is None:
+                path.pop()
+                state[key] = 'done'
+                order.append(pkg)
+                continue
+            require(dep, pkg['name'], path)
+    return order, missing, cycles
+
+
 @app.route('/api/package/<name>')
 def api_package(name):
     """API endpoint to find a package by name for CLI downloads."""
@@ -563,20 +2891,119 @@ def api_package(name):
         return jsonify({'error': 'Package name required'}), 400
     
     name = name.strip()
-    
+
+    # ?version=<constraint> resolves against the published versions, e.g. 1.2.3, ^1.2, >=1.0,<2
+    constraint = request.args.get('version')
+    if constraint is not None:
+        try:
+            version = resolve_package_version(name, constraint)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if not version:
+            return jsonify({'error': 'No matching version', 'found': False, 'constraint': constraint}), 404
+        resp = jsonify(dict(found=True, **version_payload(version)))
+        if constraint.strip() == version['version']:
+            # a pinned version never changes; a range may resolve differently after the next publish
+            resp.cache_control.public = True
+            resp.cache_control.max_age = BLOB_MAX_AGE
+            resp.cache_control.immutable = True
+        return resp
+
     # Look up package in database
     pkg = get_package_by_name(name)
     
     if not pkg:
         return jsonify({'error': 'Package not found', 'found': False}), 404
     
+    return jsonify(dict(found=True, **package_payload(pkg)))
+
+
+@app.route('/api/package/<name>/versions')
+def api_package_versions(name):
+    """Every published version of a package, newest first."""
+    versions = get_package_versions(name.strip())
+    if not versions:
+        return jsonify({'error': 'Package not found', 'found': False}), 404
+    return jsonify({'found': True, 'name': versions[0]['name'], 'versions': [version_payload(v) for v in versions]})
+
+
+@app.route('/api/index')
+def api_index():
+    """Compact snapshot of the whole catalog, or a delta with ?since=<generation>.
+
+    Responses carry a strong ETag derived from the publish generation, so clients
+    can revalidate with If-None-Match for the cost of a 304.
+    """
+    etag, render_body = package_index_document(request.args.get('since', type=int))
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = app.response_class(render_body(), mimetype='application/json')
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+@app.route('/api/package/<name>/dependencies')
+def api_package_dependencies(name):
+    """Direct dependencies of a package, or the full closure with ?transitive=1."""
+    pkg = get_package_by_name(name.strip())
+    if not pkg:
+        return jsonify({'error': 'Package not found', 'found': False}), 404
+    if request.args.get('transitive', '0').lower() in ('1', 'true'):
+        packages, missing, cycles = resolve_dependencies([pkg['name']])
+        # the closure is in install order and ends with the package itself
+        return jsonify({'found': True, 'name': pkg['name'], 'dependencies': packages[:-1] if packages else [],
+                        'missing': missing, 'cycles': cycles})
+    return jsonify({'found': True, 'name': pkg['name'], 'dependencies': get_package_dependencies(pkg['id'])})
+
+
+@app.route('/api/package/<name>/dependents')
+def api_package_dependents(name):
+    """Packages that depend on name directly, or transitively with ?transitive=1."""
+    name = name.strip()
+    if not name:
+        return jsonify({'error': 'Package name required'}), 400
+    if request.args.get('transitive', '0').lower() in ('1', 'true'):
+        dependents, cycles = reverse_dependency_closure(name)
+        return jsonify({'name': name, 'dependents': dependents, 'cycles': cycles})
+    return jsonify({'name': name, 'dependents': get_package_dependents(name)})
+
+
+# upper bound on root names accepted by one /api/resolve call
+MAX_RESOLVE_NAMES = 64
+
+
+@app.route('/api/resolve', methods=['GET', 'POST'])
+def api_resolve():
+    """Resolve one or more packages to their full dependency closure in install order.
+
+    GET /api/resolve?packages=a,b or POST {"packages": ["a", "b>=2"]}. Version constraints
+    on names and dependencies are honoured; one with a comma (">=1,<2") needs the POST form.
+    """
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        if body is None:
+            body = {}
+        if not isinstance(body, dict):
+            return jsonify({'error': 'Request body must be a JSON object'}), 400
+        names = body.get('packages') or []
+        if not isinstance(names, list):
+            return jsonify({'error': 'packages must be a list'}), 400
+    else:
+        names = request.args.get('packages', '').split(',')
+    names = [n.strip() for n in names if isinstance(n, str) and n.strip()]
+    if not names:
+        return jsonify({'error': 'Package name required'}), 400
+    if len(names) > MAX_RESOLVE_NAMES:
+        return jsonify({'error': f'At most {MAX_RESOLVE_NAMES} packages per request'}), 400
+
+    packages, missing, cycles = resolve_dependencies(names)
     return jsonify({
-        'found': True,
-        'name': pkg['name'],
-        'filename': pkg['filename'],
-        'username': pkg['username'],
-        'size': pkg['size'],
-        'download_url': f"/userfiles/{pkg['username']}/{pkg['filename']}"
+        'found': not missing,
+        'packages': packages,
+        'missing': missing,
+        'cycles': cycles,
     })
 
 
@@ -585,41 +3012,22 @@ def packages():
     """List all public packages with sorting options."""
     sort_by = request.args.get('sort', 'name')  # name, date, size
     order = request.args.get('order', 'asc')    # asc, desc
-    
-    all_packages = []
-    if os.path.isdir(PUBLIC_DIR):
-        for username in os.listdir(PUBLIC_DIR):
-            user_dir = os.path.join(PUBLIC_DIR, username)
-            if not os.path.isdir(user_dir):
-                continue
-            for fn in os.listdir(user_dir):
-                if allowed_file(fn):
-                    filepath = os.path.join(user_dir, fn)
-                    try:
-                        stats = os.stat(filepath)
-                        filesize = stats.st_size
-                        modified = stats.st_mtime
-                    except OSError:
-                        filesize = 0
-                        modified = 0
-                    all_packages.append({
-                        'filename': fn,
-                        'username': username,
-                        'name': fn.rsplit('.', 1)[0],
-                        'size': filesize,
-                        'modified': modified
-                    })
-    
-    # Sort packages
-    reverse = (order == 'desc')
-    if sort_by == 'date':
-        all_packages.sort(key=lambda p: p['modified'], reverse=reverse)
-    elif sort_by == 'size':
-        all_packages.sort(key=lambda p: p['size'], reverse=reverse)
-    else:  # default: name
-        all_packages.sort(key=lambda p: p['name'].lower(), reverse=reverse)
-    
-    return render_template('packages.html', packages=all_packages, sort_by=sort_by, order=order)
+    if sort_by not in PACKAGE_SORT_COLUMNS:
+        sort_by = 'name'
+    if order not in ('asc', 'desc'):
+        order = 'asc'
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+    except ValueError:
+        page = 1
+
+    # fetch one extra row to know whether a next page exists without a COUNT(*)
+    rows = list_packages(sort_by, order, limit=PACKAGES_PER_PAGE + 1,
+                         offset=(page - 1) * PACKAGES_PER_PAGE)
+    has_next = len(rows) > PACKAGES_PER_PAGE
+
+    return render_template('packages.html', packages=rows[:PACKAGES_PER_PAGE], sort_by=sort_by, order=order,
+                           page=page, has_next=has_next)
 
 
 @app.route('/package/<username>/<filename>')
@@ -633,23 +3041,34 @@ def package_info(username, filename):
     
     # Find the package file
     filepath = os.path.join(PUBLIC_DIR, username, filename)
-    if not os.path.isfile(filepath):
+    try:
+        stats = os.stat(filepath)
+    except OSError:
+        abort(404)
+    if not stat.S_ISREG(stats.st_mode):
         abort(404)
     
-    # Parse manifest
-    manifest = parse_leaf_manifest(filepath)
+    # Parse manifest (cached until the file changes)
+    manifest = manifest_cache.get(filepath, stats)
     
-    # Get file stats
-    stats = os.stat(filepath)
     filesize = stats.st_size
     modified = stats.st_mtime
+
+    name = filename.rsplit('.', 1)[0]
+    used_by = get_package_dependents(name)
+    # admins see how much a delete would break before they press it
+    impact = None
+    if (session.get('role') or 'member').lower() in ('admin', 'owner') and used_by:
+        impact = len(reverse_dependency_closure(name)[0])
     
     return render_template('package_info.html',
         username=username,
         filename=filename,
         manifest=manifest,
         filesize=filesize,
-        modified=modified
+        modified=modified,
+        used_by=used_by,
+        impact=impact
     )
 
 
@@ -665,22 +3084,29 @@ def upload():
         filename = secure_filename(file.filename)
         if not allowed_file(filename):
             abort(400, 'Only .leaf files are allowed')
+        staged = file.stream
+        if not isinstance(staged, StagedUpload):
+            abort(400)
+        digest, error = staged.finish()
+        if error:
+            abort(400, error)
+        staged.close()
+        conflict = publish_conflict(staged.path, session.get('user'), filename, digest)
+        if conflict:
+            abort(409, conflict)
+        user = session.get('user')
         role = (session.get('role') or 'member').lower()
         if role in ('admin', 'owner'):
-            # privileged users: upload directly to public under user's namespace
-            user = session.get('user')
-            user_public = os.path.join(PUBLIC_DIR, user)
-            os.makedirs(user_public, exist_ok=True)
-            dest = os.path.join(user_public, filename)
-            file.save(dest)
-            register_package(user, filename)
+            # privileged users: publish directly to public under user's namespace, in the background
+            enqueue_job('publish', {'src': stage_for_publish(staged.path), 'username': user,
+                                    'filename': filename, 'digest': digest}, created_by=user)
         else:
-            # store submissions under a per-user directory
-            user = session.get('user')
+            # store submissions under a per-user directory; the rename means the review
+            # queue never sees a partially written file
             user_dir = os.path.join(SUBMISSIONS_DIR, user)
-            dest = os.path.join(user_dir, filename)
             os.makedirs(user_dir, exist_ok=True)
-            file.save(dest)
+            os.replace(staged.path, os.path.join(user_dir, filename))
+            record_submission(user, filename, digest)
         return redirect(url_for('upload_success'))
     return render_template('upload.html', form=form)
 
@@ -693,7 +3119,11 @@ def signup():
         if not username or not password:
             flash('Username and password are required')
             return render_template('signup.html')
-        ok = create_user(username, password)
+        try:
+            ok = create_user(username, password)
+        except PasswordHasherBusy:
+            flash('The server is busy, please try again in a moment')
+            return render_template('signup.html'), 503, {'Retry-After': '5'}
         if not ok:
             flash('Could not create user — username may already exist')
             return render_template('signup.html')
@@ -718,7 +3148,12 @@ def login():
             flash('Username and password required')
             return render_template('login.html')
         user = get_user_by_username(username)
-        if not user or not check_password_hash(user['password_hash'], password):
+        try:
+            valid = user is not None and verify_user_password(user, password)
+        except PasswordHasherBusy:
+            flash('The server is busy, please try again in a moment')
+            return render_template('login.html'), 503, {'Retry-After': '5'}
+        if not valid:
             flash('Invalid credentials')
             return render_template('login.html')
         # Check if user is banned
@@ -774,7 +3209,41 @@ def manifest(filename):
     if not os.path.isfile(requested_path):
         abort(404)
     relpath = os.path.relpath(requested_path, PUBLIC_DIR)
-    return send_from_directory(PUBLIC_DIR, relpath, as_attachment=True)
+    return send_public_file(relpath)
+
+
+def send_public_file(relpath):
+    """Send a file under PUBLIC_DIR as a download with validators, Range support and cache headers."""
+    if ACCEL_REDIRECT_PREFIX:
+        # nginx serves the bytes (and handles Range/conditional requests) from its internal location
+        resp = app.response_class(mimetype='application/octet-stream')
+        resp.headers['X-Accel-Redirect'] = ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + quote(relpath)
+        resp.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(os.path.basename(relpath))}"
+        resp.cache_control.public = True
+        resp.cache_control.max_age = PACKAGE_MAX_AGE
+        return resp
+    # send_file answers If-None-Match/If-Modified-Since with 304 and Range with 206
+    return send_from_directory(PUBLIC_DIR, relpath, as_attachment=True, conditional=True, etag=True,
+                               max_age=PACKAGE_MAX_AGE)
+
+
+BLOB_DIGEST_RE = re.compile(r'[0-9a-f]{64}')
+# blob URLs never change content, so clients and proxies may keep them for a year
+BLOB_MAX_AGE = 365 * 24 * 3600
+
+
+@app.route('/blobs/<digest>')
+def blob_download(digest):
+    """Serve package bytes by sha256; the URL is immutable."""
+    if not BLOB_DIGEST_RE.fullmatch(digest):
+        abort(404)
+    if not os.path.isfile(blob_path(digest)):
+        abort(404)
+    resp = send_from_directory(BLOBS_DIR, f'{digest[:2]}/{digest}', as_attachment=True,
+                               download_name=f'{digest}.leaf', mimetype='application/octet-stream',
+                               conditional=True, etag=digest, max_age=BLOB_MAX_AGE)
+    resp.cache_control.immutable = True
+    return resp
 
 
 @app.route('/users/<username>')
@@ -784,18 +3253,8 @@ def user_profile(username):
     if not user:
         abort(404)
 
-    # find a profile image with a supported extension, fall back to default
-    profile_url = url_for('static', filename='images/defaultprofilepicture.jpg')
-    profiles_dir = os.path.join(BASE_DIR, 'static', 'images', 'profiles')
-    for ext in AVATAR_EXTS:
-        candidate = os.path.join(profiles_dir, f"{username}{ext}")
-        if os.path.isfile(candidate):
-            try:
-                mtime = int(os.path.getmtime(candidate))
-            except Exception:
-                mtime = 0
-            profile_url = url_for('static', filename=f'images/profiles/{username}{ext}', v=mtime)
-            break
+    # profile image from the stored avatar extension, falling back to default
+    profile_url = avatar_url(username, user['avatar_ext'], user['avatar_version'])
 
     # list packages only from public area
     user_dir = os.path.join(PUBLIC_DIR, username)
@@ -859,11 +3318,9 @@ def ban_user_route(username):
 @app.route('/userfiles/<username>/<path:filename>')
 def user_file_download(username, filename):
     # serve a user's public file; only allow .leaf and safe paths
+    # (no user lookup: a missing user has no directory, so the file check below 404s)
     if not allowed_file(filename):
         abort(400)
-    # ensure the user exists
-    if not get_user_by_username(username):
-        abort(404)
     user_dir = os.path.join(PUBLIC_DIR, username)
     requested_path = os.path.normpath(os.path.join(user_dir, filename))
     try:
@@ -874,42 +3331,102 @@ def user_file_download(username, filename):
         abort(403)
     if not os.path.isfile(requested_path):
         abort(404)
-    relpath = os.path.relpath(requested_path, user_dir)
-    return send_from_directory(user_dir, relpath, as_attachment=True)
+    relpath = os.path.relpath(requested_path, PUBLIC_DIR)
+    return send_public_file(relpath)
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint (LEAF_METRICS=true); requires the LEAF_METRICS_TOKEN bearer token."""
+    if not METRICS_ENABLED:
+        abort(404)
+    supplied = request.headers.get('Authorization', '').encode()
+    if not METRICS_TOKEN or not hmac.compare_digest(supplied, f'Bearer {METRICS_TOKEN}'.encode()):
+        abort(403)
+    return app.response_class(render_metrics(), mimetype='text/plain; version=0.0.4')
 
 
 # ------------------------ Admin Review ------------------------
+@app.route('/admin/stats')
+def admin_stats():
+    """Operator counters for the data layer and caches (admin/owner only)."""
+    role = (session.get('role') or 'member').lower()
+    if role not in ('admin', 'owner'):
+        abort(403)
+    return jsonify({'db': db_stats(), 'manifest_cache': manifest_cache.stats(),
+                    'session_user_cache': session_user_cache.stats(), 'jobs': job_counts(),
+                    'password_hasher': password_hasher.stats(), 'page_cache': page_cache.stats()})
+
+
+@app.route('/admin/jobs')
+def admin_jobs():
+    """Recent background jobs, newest first; ?status=queued|running|done|failed (admin/owner only)."""
+    role = (session.get('role') or 'member').lower()
+    if role not in ('admin', 'owner'):
+        abort(403)
+    status = request.args.get('status') or None
+    if status and status not in JOB_STATUSES:
+        abort(400)
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    return jsonify({'counts': job_counts(), 'jobs': list_jobs(status, limit)})
+
+
+@app.route('/admin/jobs/<int:job_id>')
+def admin_job(job_id):
+    role = (session.get('role') or 'member').lower()
+    if role not in ('admin', 'owner'):
+        abort(403)
+    job = get_job(job_id)
+    if not job:
+        abort(404)
+    return jsonify(job)
+
+
+@app.route('/admin/jobs/<int:job_id>/retry', methods=['POST'])
+def admin_job_retry(job_id):
+    """Put a failed job back on the queue with a fresh set of attempts."""
+    role = (session.get('role') or 'member').lower()
+    if role not in ('admin', 'owner'):
+        abort(403)
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("UPDATE jobs SET status = 'queued', attempts = 0, run_after = ?, updated_at = ? "
+              "WHERE id = ? AND status = 'failed'", (time.time(), int(time.time()), job_id))
+    conn.commit()
+    if c.rowcount == 0:
+        abort(404)
+    ensure_job_workers()
+    with _job_wakeup:
+        _job_wakeup.notify()
+    return jsonify(get_job(job_id))
+
+
 @app.route('/admin/review')
 def admin_review():
     role = (session.get('role') or 'member').lower()
     if role not in ('admin', 'owner'):
         abort(403)
-    # collect all pending submissions by user
-    pending = []
-    if os.path.isdir(SUBMISSIONS_DIR):
-        for uname in sorted(os.listdir(SUBMISSIONS_DIR)):
-            udir = os.path.join(SUBMISSIONS_DIR, uname)
-            if os.path.isdir(udir):
-                for fn in sorted(os.listdir(udir)):
-                    if allowed_file(fn):
-                        pending.append({'username': uname, 'filename': fn})
-    # optionally view a selected file
+    status = request.args.get('status', 'pending')
+    if status not in SUBMISSION_STATUSES:
+        status = 'pending'
+    submitter = request.args.get('user', '').strip()
+    query = request.args.get('q', '').strip()
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+    except ValueError:
+        page = 1
+    # one extra row tells us whether there is a next page
+    rows = list_submissions(status, submitter or None, query or None, limit=SUBMISSIONS_PER_PAGE + 1,
+                            offset=(page - 1) * SUBMISSIONS_PER_PAGE)
+    has_next = len(rows) > SUBMISSIONS_PER_PAGE
+    # optionally view a selected submission; the preview comes from the stored manifest
     sel_user = request.args.get('u', '').strip()
     sel_file = request.args.get('f', '').strip()
-    sel_content = None
-    if sel_user and sel_file and allowed_file(sel_file):
-        view_path = os.path.normpath(os.path.join(SUBMISSIONS_DIR, sel_user, sel_file))
-        try:
-            common = os.path.commonpath([os.path.join(SUBMISSIONS_DIR, sel_user), view_path])
-        except ValueError:
-            view_path = None
-        if view_path and os.path.isfile(view_path):
-            try:
-                with open(view_path, 'r', encoding='utf-8') as f:
-                    sel_content = f.read()
-            except Exception:
-                sel_content = '(unable to read file)'
-    return render_template('admin_review.html', pending=pending, sel_user=sel_user, sel_file=sel_file, sel_content=sel_content)
+    selected = get_submission(sel_user, sel_file, status) if sel_user and sel_file else None
+    sel_content = selected['manifest'] if selected else None
+    return render_template('admin_review.html', pending=rows[:SUBMISSIONS_PER_PAGE], status=status,
+                           submitter=submitter, query=query, page=page, has_next=has_next, selected=selected,
+                           sel_user=sel_user, sel_file=sel_file, sel_content=sel_content)
 
 
 @app.route('/admin/review/accept', methods=['POST'])
@@ -929,17 +3446,19 @@ def admin_accept():
         abort(400)
     if common != src_dir or not os.path.isfile(src):
         abort(404)
-    # move to public under user's namespace
-    dst_dir = os.path.join(PUBLIC_DIR, username)
-    os.makedirs(dst_dir, exist_ok=True)
-    dst = os.path.join(dst_dir, filename)
+    conflict = publish_conflict(src, username, filename)
+    if conflict:
+        flash(conflict)
+        return redirect(url_for('admin_review', u=username, f=filename))
+    # publish to public under user's namespace; moving it out of submissions takes it off the review list
     try:
-        shutil.move(src, dst)
-        register_package(username, filename)
-        flash('Accepted and published')
+        job_id = enqueue_job('publish', {'src': stage_for_publish(src), 'username': username, 'filename': filename},
+                             created_by=session.get('user'))
+        close_submissions([(username, filename)], 'accepted', session.get('user'), job_id)
+        flash(f'Accepted; publishing as job #{job_id}')
     except Exception:
         flash('Failed to publish')
-    return redirect(url_for('admin_review', u=username, f=filename))
+    return redirect(url_for('admin_review'))
 
 
 @app.route('/admin/review/deny', methods=['POST'])
@@ -962,6 +3481,7 @@ def admin_deny():
     if os.path.isfile(src):
         try:
             os.remove(src)
+            close_submissions([(username, filename)], 'denied', session.get('user'))
             flash('Denied and removed')
         except Exception:
             flash('Failed to remove')
@@ -970,6 +3490,108 @@ def admin_deny():
     return redirect(url_for('admin_review'))
 
 
+MAX_BULK_REVIEW_ITEMS = 1000
+
+
+def _submission_path(username, filename):
+    """SUBMISSIONS_DIR/<username>/<filename>, or None if the pair is invalid or escapes the directory."""
+    if not username or not allowed_file(filename):
+        return None
+    src_dir = os.path.join(SUBMISSIONS_DIR, username)
+    src = os.path.normpath(os.path.join(src_dir, filename))
+    try:
+        if os.path.commonpath([src_dir, src]) != src_dir:
+            return None
+    except ValueError:
+        return None
+    return src
+
+
+@app.route('/admin/review/bulk', methods=['POST'])
+def admin_review_bulk():
+    """Accept or deny many submissions in one request.
+
+    Takes JSON {"action": "accept"|"deny", "items": [{"username": ..., "filename": ...}, ...]}
+    and answers with one result per item; accepted files are published by a single job.
+    The review page posts the same as a form (action plus repeated item=username/filename)
+    and gets a redirect back.
+    """
+    role = (session.get('role') or 'member').lower()
+    if role not in ('admin', 'owner'):
+        abort(403)
+    if request.is_json:
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(400)
+        action = body.get('action')
+        raw_items = body.get('items') or []
+        if not isinstance(raw_items, list):
+            abort(400)
+        pairs = [(str(i.get('username', '')).strip(), str(i.get('filename', '')).strip())
+                 for i in raw_items if isinstance(i, dict)]
+    else:
+        action = request.form.get('action')
+        pairs = [tuple(part.strip() for part in item.partition('/')[::2]) for item in request.form.getlist('item')]
+    if action not in ('accept', 'deny') or not pairs:
+        abort(400)
+    if len(pairs) > MAX_BULK_REVIEW_ITEMS:
+        abort(413)
+    reviewer = session.get('user')
+
+    results, done, publish_items = [], [], []
+    seen = set()
+    names = {}  # normalized name -> first item in this batch that claims it
+    for username, filename in pairs:
+        result = {'username': username, 'filename': filename}
+        results.append(result)
+        src = _submission_path(username, filename)
+        if src is None:
+            result.update(status='error', error='invalid submission')
+            continue
+        if (username, filename) in seen:
+            result.update(status='error', error='duplicate item')
+            continue
+        seen.add((username, filename))
+        try:
+            if action == 'accept':
+                conflict = publish_conflict(src, username, filename)
+                name_key = normalize_package_name(filename.rsplit('.', 1)[0])
+                claimant = names.setdefault(name_key, (username, filename))
+                if not conflict and claimant != (username, filename):
+                    conflict = f'The package name is claimed by {claimant[0]}/{claimant[1]} earlier in this batch'
+                if conflict:
+                    result.update(status='error', error=conflict)
+                    continue
+                # moving out of submissions takes it off the review list
+                publish_items.append({'src': stage_for_publish(src), 'username': username, 'filename': filename})
+            else:
+                os.remove(src)
+        except FileNotFoundError:
+            result.update(status='error', error='not found')
+            continue
+        except OSError as e:
+            result.update(status='error', error=str(e))
+            continue
+        result['status'] = 'queued' if action == 'accept' else 'denied'
+        done.append((username, filename))
+
+    job_id = None
+    if publish_items:
+        job_id = enqueue_job('publish_batch', {'items': publish_items}, created_by=reviewer)
+    if done:
+        close_submissions(done, 'accepted' if action == 'accept' else 'denied', reviewer, job_id)
+
+    if request.is_json:
+        return jsonify({'action': action, 'job_id': job_id, 'results': results})
+    failed = len(results) - len(done)
+    if action == 'accept':
+        message = f'Accepted {len(done)}' + (f'; publishing as job #{job_id}' if job_id else '')
+    else:
+        message = f'Denied {len(done)}'
+    flash(message + (f', {failed} failed' if failed else ''))
+    return redirect(url_for('admin_review'))
+
+
 @app.route('/users/<username>/delete/<path:filename>', methods=['POST'])
 def delete_user_file(username, filename):
     # Allow admin/owner to delete a user's published .leaf from public namespace
@@ -996,8 +3618,13 @@ def delete_user_file(username, filename):
     if os.path.isfile(requested_path):
         try:
             os.remove(requested_path)
+            manifest_cache.invalidate(requested_path)
             unregister_package(username, filename)
-            flash('Package deleted')
+            dependents = get_package_dependents(filename.rsplit('.', 1)[0])
+            if dependents:
+                flash(f'Package deleted; {len(dependents)} package(s) still depend on it')
+            else:
+                flash('Package deleted')
         except Exception:
             flash('Failed to delete package')
     else:
@@ -1037,11 +3664,12 @@ def edit_profile(username):
 
         # update DB
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = get_db()
             c = conn.cursor()
             c.execute('UPDATE users SET username = ?, username_changed_at = ? WHERE id = ?', (new_username, now, u['id']))
+            _index_user_search(c, u['id'], new_username)
             conn.commit()
-            conn.close()
+            session_user_cache.invalidate(user_uuid=u.get('uuid'))
         except Exception:
             flash('Failed to change username')
             return redirect(url_for('user_profile', username=username))
@@ -1052,14 +3680,16 @@ def edit_profile(username):
         try:
             if os.path.isdir(old_dir):
                 shutil.move(old_dir, new_dir)
+                conn = get_db()
+                conn.execute('UPDATE submissions SET username = ? WHERE username = ?', (new_username, username))
+                conn.commit()
         except Exception:
             pass
 
         # move avatar files
-        profiles_dir = os.path.join(BASE_DIR, 'static', 'images', 'profiles')
         for e in AVATAR_EXTS:
-            oldp = os.path.join(profiles_dir, f"{username}{e}")
-            newp = os.path.join(profiles_dir, f"{new_username}{e}")
+            oldp = os.path.join(PROFILES_DIR, f"{username}{e}")
+            newp = os.path.join(PROFILES_DIR, f"{new_username}{e}")
             try:
                 if os.path.isfile(oldp):
                     shutil.move(oldp, newp)
@@ -1072,11 +3702,10 @@ def edit_profile(username):
 
     # update bio
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         c = conn.cursor()
         c.execute('UPDATE users SET bio = ? WHERE username = ?', (new_bio, username))
         conn.commit()
-        conn.close()
     except Exception:
         flash('Failed to save bio')
         return redirect(url_for('user_profile', username=username))
@@ -1088,18 +3717,26 @@ def edit_profile(username):
             filename = secure_filename(f.filename)
             ext = os.path.splitext(filename)[1].lower()
             if ext in AVATAR_EXTS:
-                profiles_dir = os.path.join(BASE_DIR, 'static', 'images', 'profiles')
-                os.makedirs(profiles_dir, exist_ok=True)
+                os.makedirs(PROFILES_DIR, exist_ok=True)
                 # remove existing avatar files with other extensions
                 for e in AVATAR_EXTS:
-                    existing = os.path.join(profiles_dir, f"{username}{e}")
+                    existing = os.path.join(PROFILES_DIR, f"{username}{e}")
                     try:
                         if os.path.isfile(existing):
                             os.remove(existing)
                     except Exception:
                         pass
-                dest = os.path.join(profiles_dir, f"{username}{ext}")
+                dest = os.path.join(PROFILES_DIR, f"{username}{ext}")
                 f.save(dest)
+                # record the avatar so pages can build its URL without probing the disk
+                try:
+                    conn = get_db()
+                    conn.execute('UPDATE users SET avatar_ext = ?, avatar_version = ? WHERE id = ?',
+                                 (ext, int(time.time()), u['id']))
+                    conn.commit()
+                except Exception:
+                    pass
+                session_user_cache.invalidate(user_uuid=u.get('uuid'))
 
     flash('Profile updated')
     return redirect(url_for('user_profile', username=username))